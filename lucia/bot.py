@@ -1,21 +1,44 @@
 from os import path
 
+# 在导入其他模块之前开始计时
+from services.imports import install_import_timer, report_import_times
+install_import_timer()
+
 import nonebot
 import bot_config
 from controllers import add_controllers
-from services import db_context, inmsg_count
+from services import broadcast, db_context, inmsg_count, command_use_count, common, weather, nlp, processpool, latency, metrics, \
+    request_digest, image_store
 
 
 nonebot.init(bot_config)
 nonebot.load_plugins(path.join(path.dirname(__file__), 'bot_plugins'), 'bot_plugins')
+report_import_times('bot_plugins')
 
+nonebot.on_startup(broadcast.init)
 nonebot.on_startup(db_context.init)
 nonebot.on_startup(inmsg_count.init)
+nonebot.on_startup(command_use_count.init)
+nonebot.on_startup(common.init)
+nonebot.on_startup(weather.init)
+nonebot.on_startup(nlp.init)
+nonebot.on_startup(processpool.init)
+nonebot.on_startup(latency.init)
+nonebot.on_startup(metrics.init)
+nonebot.on_startup(image_store.init)
 
 # 如果使用 asgi
 bot = nonebot.get_bot()
 app = bot.asgi
 
+# 退出前把尚未写入数据库的计数写回，把还没发出的请求摘要发出去
+bot.server_app.after_serving(command_use_count.shutdown)
+bot.server_app.after_serving(request_digest.send_digest)
+bot.server_app.after_serving(common.shutdown)
+bot.server_app.after_serving(weather.shutdown)
+bot.server_app.after_serving(image_store.shutdown)
+bot.server_app.after_serving(broadcast.shutdown)
+
 add_controllers(bot.server_app)
 
 if __name__ == '__main__':
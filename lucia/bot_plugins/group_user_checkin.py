@@ -1,9 +1,17 @@
+import asyncio
+
 from nonebot import get_bot
 from nonebot.command import CommandSession
+from nonebot.exceptions import CQHttpError
 from nonebot.plugin import on_command
 from aiocqhttp.message import MessageSegment
 
-from services.group_user_checkin import group_user_check_in, group_user_check, group_user_check_use_b64img
+from service_config import MEMBER_NAME_CACHE_SIZE, MEMBER_NAME_CACHE_TTL
+from services.cache import LRUCache
+from services.common import ServiceException
+from services.group_user_checkin import group_user_check_in, group_user_check, group_user_check_use_img, \
+    group_leaderboard, group_leaderboard_use_img
+from services.leaderboard import get_ranking
 from services.command_use_count import record_successful_invocation
 
 
@@ -11,13 +19,17 @@ __plugin_name__ = '签到'
 __plugin_usage__ = (
     '用法：\n'
     '对我说 “签到” 来签到\n'
-    '“我的签到” 或 “我的签到 文本” 来获取历史签到信息'
+    '“我的签到” 或 “我的签到 文本” 来获取历史签到信息\n'
+    '“好感度排行” 或 “好感度排行 文本” 来查看本群的好感度排行'
 )
 
 
 # 此功能只在群聊有效
 checkin_permission = lambda sender: sender.is_groupchat
 
+# 群成员显示的名字，键为 (群号, QQ 号)。名片很少改变，不必每次查看排行都向 gocqhttp 查询
+_member_names: LRUCache[tuple[int, int], str] = LRUCache(MEMBER_NAME_CACHE_SIZE, MEMBER_NAME_CACHE_TTL, name='member_name')
+
 
 @on_command('签到', permission=checkin_permission)
 @record_successful_invocation('签到')
@@ -37,6 +49,39 @@ async def _(session: CommandSession):
     else:
         # 使用 bot 对象来主动调用 api
         nickname = (await get_bot().get_stranger_info(user_id=user_id))['nickname'] # type: ignore
-        im_b64 = await group_user_check_use_b64img(user_id, group_id, nickname)
-        await session.send(MessageSegment.image(f'base64://{im_b64}'), at_sender=True)
+        try:
+            im_file = await group_user_check_use_img(user_id, group_id, nickname)
+        except ServiceException as e:
+            await session.send(e.message, at_sender=True)
+            return
+        await session.send(MessageSegment.image(im_file), at_sender=True)
+
+
+@on_command('好感度排行', permission=checkin_permission)
+@record_successful_invocation('好感度排行')
+async def _(session: CommandSession):
+    user_id, group_id = session.event.user_id, session.event.group_id
+    if session.current_arg and session.current_arg.strip() == '文本':
+        await session.send(await group_leaderboard(user_id, group_id), at_sender=True)
+        return
 
+    ranking = await get_ranking(user_id, group_id)
+    bot = get_bot()
+    async def _name(qq: int) -> str:
+        if (name := _member_names.get((group_id, qq))) is not None:
+            return name
+        try:
+            member = await bot.get_group_member_info(group_id=group_id, user_id=qq)
+        except CQHttpError:
+            return str(qq)
+        name = member.get('card') or member.get('nickname') or str(qq)
+        _member_names.put((group_id, qq), name)
+        return name
+    qqs = list({ qq for qq, _ in ranking.top } | { user_id })
+    names = dict(zip(qqs, await asyncio.gather(*(_name(qq) for qq in qqs))))
+    try:
+        im_file = await group_leaderboard_use_img(ranking, names)
+    except ServiceException as e:
+        await session.send(e.message, at_sender=True)
+        return
+    await session.send(MessageSegment.image(im_file), at_sender=True)
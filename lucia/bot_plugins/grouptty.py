@@ -6,8 +6,15 @@ from nonebot.helpers import context_id
 from nonebot.exceptions import CQHttpError
 from nonebot.plugin import on_command
 
+from service_config import (
+    GROUPTTY_BATCH_WINDOW, GROUPTTY_BATCH_MAX_LINES, GROUPTTY_BATCH_MAX_CHARS,
+    GROUPTTY_SEND_RATE, GROUPTTY_SEND_BURST, GROUPTTY_QUEUE_SIZE,
+)
 from services.command_use_count import record_successful_invocation
-from services.broadcast import broadcast, listen_to_broadcasts
+from services.broadcast import broadcast, has_subscribers, listen_to_broadcasts
+from services.latency import timed
+from services.log import logger
+from services.ratelimit import TokenBucket
 
 
 __plugin_name__ = 'grouptty'
@@ -23,22 +30,37 @@ __plugin_usage__ = (
 # 收到群聊消息时要广播一下
 # 没错我们可以定义多个消息预处理器
 @message_preprocessor
+@timed('preprocessor.grouptty')
 async def _(bot, event: CQEvent, manager):
     if not event.group_id:
         return
+    # 没有人在监听这个群就什么也不用做
+    topic = f'grouptty-{event.group_id}'
+    if not has_subscribers(topic):
+        return
 
     async def _bc():
         return {
-            'message': event.message,
+            'message': str(event.message),
             'user_id': event.user_id,
             'name': event.sender['card'] or event.sender['nickname'],
         }
-                                  # 订阅的群组
-    asyncio.create_task(broadcast(f'grouptty-{event.group_id}', _bc))
+    # 接入的 tty 可能在另一个工作进程里
+    asyncio.create_task(broadcast(topic, _bc, shared=True))
 
 
 grouptty_permission = lambda sender: sender.is_superuser
 
+
+def _format_line(payload) -> str:
+    ev = payload['data']
+    line = f'{ev["user_id"]} ({ev["name"]}): {ev["message"]}'
+    # 单条消息太长就截断，不然一条就占满整批
+    if len(line) > GROUPTTY_BATCH_MAX_CHARS:
+        line = line[:GROUPTTY_BATCH_MAX_CHARS - 1] + '…'
+    return line
+
+
 # tty 发起者的 context（即 qq 号码 + 发起者群号（如果有）生成的唯一 ID） 值为相应的群号和从广播提取消息的循环
 _ttys: dict[str, tuple[int, asyncio.Task]] = {}
 
@@ -63,12 +85,59 @@ async def _(session: CommandSession):
         return
 
     async def _receive():
-        # 订阅的群组
-        with listen_to_broadcasts(f'grouptty-{group}') as get:
+        loop = asyncio.get_event_loop()
+        bucket = TokenBucket(GROUPTTY_SEND_RATE, GROUPTTY_SEND_BURST)
+        # 上一批装不下、留给下一批的那一行
+        carry = None
+        reported_dropped = 0
+        # 订阅的群组。发送跟不上时积压的消息有上限，超出的最旧的消息会被跳过
+        with listen_to_broadcasts(
+            f'grouptty-{group}', maxsize=GROUPTTY_QUEUE_SIZE, overflow='drop-oldest',
+        ) as get:
+            def _note_skipped(lines: list[str]):
+                # 被跳过的消息比已经取出的新，比之后取出的旧，所以在取出下一条之前提示
+                nonlocal reported_dropped
+                if (skipped := get.dropped - reported_dropped) > 0:
+                    lines.append(f'（跳过了 {skipped} 条消息）')
+                    reported_dropped = get.dropped
+
             while True:
-                ev = (await get())['data']
+                # 等到第一条消息，再收集一小段时间内到达的其他消息合并成一条发送
+                lines: list[str] = []
+                if carry is None:
+                    first = _format_line(await get())
+                    _note_skipped(lines)
+                else:
+                    first, carry = carry, None
+                lines.append(first)
+                size = len(first)
+                deadline = loop.time() + GROUPTTY_BATCH_WINDOW
+                while len(lines) < GROUPTTY_BATCH_MAX_LINES:
+                    if len(get):
+                        payload = await get()
+                    elif (timeout := deadline - loop.time()) > 0:
+                        try:
+                            payload = await asyncio.wait_for(get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        break
+                    line = _format_line(payload)
+                    if size + len(line) > GROUPTTY_BATCH_MAX_CHARS:
+                        carry = line
+                        break
+                    _note_skipped(lines)
+                    lines.append(line)
+                    size += len(line)
+
+                await bucket.acquire()
+                if carry is None:
+                    _note_skipped(lines)
                 # 转发消息给当前会话
-                await bot.send(event, f'grouptty: {ev["user_id"]} ({ev["name"]}): {ev["message"]}')
+                try:
+                    await bot.send(event, 'grouptty:\n' + '\n'.join(lines))
+                except CQHttpError as e:
+                    logger.exception(e)
 
     _ttys[context_id(session.event)] = (int(group), asyncio.create_task(_receive()))
     await session.send('grouptty: 开始')
@@ -1,11 +1,13 @@
 from nonebot import message_preprocessor
 
 from services import inmsg_count
+from services.latency import timed
 
 
 __plugin_name__ = '消息计数 [Hidden]'
 
 
 @message_preprocessor
+@timed('preprocessor.inmsg_count')
 async def _(bot, event, manager):
-    await inmsg_count.increase_now()
+    inmsg_count.increase_now(event.detail_type, event.group_id)
@@ -1,7 +1,8 @@
-from nonebot import get_bot, on_request
-from nonebot.helpers import send_to_superusers
+from nonebot import on_request
 from nonebot.notice_request import RequestSession
 
+from services.request_digest import add_request
+
 
 __plugin_name__ = '处理请求 [Hidden]'
 
@@ -10,16 +11,16 @@ __plugin_name__ = '处理请求 [Hidden]'
 async def _(session: RequestSession):
     bot = session.bot
     event = session.event
-    if event.detail_type == 'friend':
-        msg = f'用户 {event.user_id} 请求添加好友。消息：{event.comment}'
-    else:  # == 'group'
-        msg = f'用户 {event.user_id} 邀请加入群 {event.group_id}。消息：{event.comment}'
 
     # 如果邀请者是超级用户，那么就自动同意请求
+    approved = False
     if event.user_id in bot.config.SUPERUSERS:
         await session.approve()
-        msg += '（已自动接受）'
+        approved = True
 
-    # 给超级用户发送这条消息
-    await send_to_superusers(bot, msg)
-    # TODO: 使用 broadcast() 广播这条消息到监控面板
+    # 记录下来并广播到监控面板。超级用户会收到一段时间内所有请求合并成的一条消息
+    add_request(
+        bot,
+        'friend' if event.detail_type == 'friend' else 'group',
+        event.user_id, event.group_id, event.comment, approved,
+    )
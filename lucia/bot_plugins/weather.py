@@ -1,9 +1,11 @@
+import re
+
 from nonebot.command import CommandSession
 from nonebot.natural_language import NLPSession, IntentCommand
 from nonebot.plugin import on_command, on_natural_language
-from jieba import posseg
 
 from services.common import ServiceException
+from services.nlp import pos_cut
 from services.weather import get_current_weather_short, get_current_weather_desc
 from services.command_use_count import record_successful_invocation
 
@@ -47,19 +49,32 @@ async def _(session: CommandSession):
     await session.send(result)
 
 
+_detailed_words = ('详细', '报告', '详情')
+
+# 形如 “香港天气”、“香港的天气” 或 “香港天气详细” 的消息不需要分词。
+# （“天气 香港” 这样的消息在这之前就已经作为 weather 命令处理了）
+_simple_pattern = re.compile(r'([^\s的]{1,10}?)的?天气\s*(' + '|'.join(_detailed_words) + r')?')
+# 这些词放在“天气”前面时不是城市
+_not_cities = {'今天', '明天', '后天', '今日', '明日', '现在', '最近', '这里', '那里', '这边', '那边', '什么'}
+
+
 # 只要消息包含“天气”，就执行此处理器
 @on_natural_language(keywords={'天气'}, permission=weather_permission)
 async def _(session: NLPSession):
-    # 使用 jieba 将消息句子分词
-    words = posseg.lcut(session.msg_text.strip())
-
+    text = session.msg_text.strip()
     args = {}
 
-    for word in words:
-        if word.flag == 'ns': # ns 表示该词为地名
-            args['city'] = word.word
-        elif word.word in ('详细', '报告', '详情'):
+    if (match := _simple_pattern.fullmatch(text)) is not None and match[1] not in _not_cities:
+        args['city'] = match[1]
+        if match[2]:
             args['is_detailed'] = True
+    else:
+        # 使用 jieba 将消息句子分词
+        for word, flag in await pos_cut(text):
+            if flag == 'ns': # ns 表示该词为地名
+                args['city'] = word
+            elif word in _detailed_words:
+                args['is_detailed'] = True
 
     # 置信度为 90，意为将此会话当作 'weather' 命令处理
     return IntentCommand(90, 'weather', args=args)
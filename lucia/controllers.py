@@ -1,10 +1,12 @@
-from json import dumps
+import datetime
 
-from quart import Quart, websocket, send_file
+from quart import Quart, request, websocket, send_file
 
 from service_config import RESOURCES_DIR
-from services import command_use_count, inmsg_count
-from services.broadcast import listen_to_broadcasts, as_payload
+from services import command_use_count, db_context, image_store, inmsg_count, processpool, latency, metrics, \
+    request_digest
+from services.broadcast import ENCODINGS, SlowConsumerError, listen_to_broadcasts, as_payload
+from services.log import logger
 
 
 def add_controllers(app: Quart):
@@ -13,14 +15,66 @@ def add_controllers(app: Quart):
     async def _dashboard_get():
         return await send_file(f'{RESOURCES_DIR}/dashboard.html')
 
+    @app.route('/metrics', ['GET'])
+    async def _metrics_get():
+        # Prometheus 文本格式，只读取内存中的数据，可以频繁抓取
+        return metrics.render(), 200, { 'Content-Type': 'text/plain; version=0.0.4; charset=utf-8' }
+
+    @app.route('/images/<name>', ['GET'])
+    async def _images_get(name: str):
+        # 渲染好的图片（IMAGE_STORE 为 'url' 时由 gocqhttp 下载）。以内容的哈希命名，内容永远不会改变
+        if not image_store.is_stored_name(name):
+            return { 'error': 'not found' }, 404
+        headers = { 'ETag': f'"{name[:-4]}"', 'Cache-Control': 'public, max-age=31536000, immutable' }
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            return '', 304, headers
+        try:
+            response = await send_file(image_store.path_of(name), mimetype='image/jpeg')
+        except FileNotFoundError:
+            # 已经被清理掉了
+            return { 'error': 'not found' }, 404
+        response.headers.update(headers)
+        return response
+
+    @app.route('/api/command-uses', ['GET'])
+    async def _command_uses_get():
+        # ?start=2020-01-01&end=2020-12-31&granularity=day|week|month，默认为最近 30 天按日统计
+        try:
+            end = datetime.date.fromisoformat(request.args['end']) if 'end' in request.args else datetime.date.today()
+            start = datetime.date.fromisoformat(request.args['start']) if 'start' in request.args \
+                else end - datetime.timedelta(days=29)
+            return await command_use_count.get_history(start, end, request.args.get('granularity', 'day'))
+        except ValueError as e:
+            return { 'error': str(e) }, 400
+
     @app.websocket('/expose')
     async def _expose_ws():
+        # 客户端可以通过 ?encoding=msgpack 选择二进制编码（需要安装 msgpack）
+        encoding = websocket.args.get('encoding', 'json')
+        if encoding not in ENCODINGS:
+            # 不悄悄换成 JSON，否则客户端会把收到的内容当作另一种编码来解析
+            logger.warning(f'Dashboard client requested unavailable encoding {encoding!r}.')
+            await websocket.accept()
+            await websocket.close(1003, f'encoding {encoding!r} is not available')
+            return
         # 主动调用 API，打上类型标签，填充完整的命令调用信息 (bootstrap)
-        await websocket.send(dumps(as_payload('messageLoad', await inmsg_count.get_count())))
-        await websocket.send(dumps(as_payload('pluginUsage', await command_use_count.get_count())))
+        await websocket.send(as_payload('messageLoad', await inmsg_count.get_count()).encode(encoding))
+        await websocket.send(as_payload('pluginUsage', await command_use_count.get_count()).encode(encoding))
+        await websocket.send(as_payload('renderPool', await processpool.get_stats()).encode(encoding))
+        await websocket.send(as_payload('handlerLatency', await latency.get_report()).encode(encoding))
+        await websocket.send(as_payload('dbPool', await db_context.get_stats()).encode(encoding))
+        await websocket.send(as_payload('requests', await request_digest.get_history()).encode(encoding))
         # 然后再接入消息队列被动获取信息
-        with listen_to_broadcasts('messageLoad', 'pluginUsage') as get:
+        # 客户端跟不上时，完整快照类的消息只保留最新的一条；增量消息积压满了就断开，客户端重连后重新获取完整信息
+        with listen_to_broadcasts(
+            'messageLoad', 'pluginUsage', 'renderPool', 'handlerLatency', 'dbPool', 'requests',
+            overflow='coalesce', snapshots=('messageLoad', 'renderPool', 'handlerLatency', 'dbPool'),
+        ) as get:
             while True:
-                payload = await get()
-                await websocket.send(dumps(payload))
+                try:
+                    payload = await get()
+                except SlowConsumerError:
+                    return
+                # 同一条广播只编码一次，所有连接共享编码结果
+                await websocket.send(payload.encode(encoding))
 
@@ -26,3 +26,19 @@ class CommandUse(db.Model):
             date=date,
             use_count=0,
         )
+
+
+class CommandUseRollup(db.Model):
+    'Use counts of each command summed over a week or a month, kept in step with `command_uses`.'
+    __tablename__ = 'command_use_rollups'
+
+    id = db.Column(db.Integer(), primary_key=True)
+    name = db.Column(db.String(), nullable=False)
+    # 'week' 或 'month'
+    period = db.Column(db.String(), nullable=False)
+    # 周一或者每月一日
+    period_start = db.Column(db.Date(), nullable=False)
+
+    use_count = db.Column(db.Integer(), nullable=False)
+
+    _idx1 = db.Index('command_use_rollups_idx1', 'period', 'name', 'period_start', unique=True)
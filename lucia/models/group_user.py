@@ -1,6 +1,9 @@
-from datetime import datetime
+from datetime import datetime, time
+from typing import NamedTuple, Optional
 
-from services.db_context import db
+from sqlalchemy.dialects.postgresql import insert
+
+from services.db_context import db, read_bind
 
 
 class GroupUser(db.Model):
@@ -15,6 +18,8 @@ class GroupUser(db.Model):
     impression = db.Column(db.Numeric(scale=3, asdecimal=False), nullable=False)
 
     _idx1 = db.Index('group_users_idx1', 'user_qq', 'belonging_group', unique=True)
+    # 好感度排行按群读取
+    _idx2 = db.Index('group_users_idx2', 'belonging_group', 'impression')
 
     @classmethod
     async def ensure(cls, user_qq: int, belonging_group: int, for_update: bool = False) -> 'GroupUser':
@@ -32,3 +37,81 @@ class GroupUser(db.Model):
             checkin_time_last=datetime.min, # 从未签到过
             impression=0,
         )
+
+    @classmethod
+    async def find(cls, user_qq: int, belonging_group: int) -> Optional['GroupUser']:
+        'Finds the user without creating it. Reads from the read database if there is one.'
+        return await read_bind().first(cls.query.where(
+            (cls.user_qq == user_qq) & (cls.belonging_group == belonging_group)
+        ))
+
+    @classmethod
+    async def impressions_of_group(cls, belonging_group: int) -> list[tuple[int, float]]:
+        '''Gets `(user_qq, impression)` of every user in the group who has checked in, in ascending order
+        of impression. Reads from the read database if there is one.
+        '''
+        rows = await read_bind().all(
+            db.select([cls.user_qq, cls.impression])
+            # 以前查询时会插入从未签到的用户，这些行不算在排行里
+            .where((cls.belonging_group == belonging_group) & (cls.checkin_count > 0))
+            .order_by(cls.impression)
+        )
+        return [(row[0], row[1]) for row in rows]
+
+    @classmethod
+    async def check_in(cls, user_qq: int, belonging_group: int, present: datetime, impression_added: float):
+        '''Checks the user in with a single statement, unless they have already checked in on the
+        day of `present`. Returns a row of `(checked_in, checkin_count, impression)` as of after it.
+        '''
+        table = cls.__table__
+        ins = insert(table).values(
+            user_qq=user_qq,
+            belonging_group=belonging_group,
+            checkin_count=1,
+            checkin_time_last=present,
+            impression=impression_added,
+        )
+        # 冲突时（用户已存在，group_users_idx1）只在今天还没签到的情况下更新
+        upsert = ins.on_conflict_do_update(
+            index_elements=[table.c.user_qq, table.c.belonging_group],
+            set_={
+                'checkin_count': table.c.checkin_count + 1,
+                'checkin_time_last': ins.excluded.checkin_time_last,
+                'impression': table.c.impression + ins.excluded.impression,
+            },
+            where=table.c.checkin_time_last < datetime.combine(present.date(), time.min),
+        ).returning(
+            db.true().label('checked_in'), table.c.checkin_count, table.c.impression,
+        ).cte('upsert')
+
+        # 没有更新时（今天已经签到过），在同一条语句中顺便读出原来的数据
+        unchanged = db.select([db.false().label('checked_in'), table.c.checkin_count, table.c.impression]) \
+            .where((table.c.user_qq == user_qq) & (table.c.belonging_group == belonging_group)) \
+            .where(~db.exists(db.select([upsert.c.checked_in])))
+
+        row = await db.select([upsert.c.checked_in, upsert.c.checkin_count, upsert.c.impression]) \
+            .union_all(unchanged) \
+            .gino.first()
+        if row is None:
+            # 同一个新用户同时签到多次时，输掉的 INSERT 与冲突的行比较后不更新，而 unchanged 读到的是
+            # 语句开始时的快照，那时赢的一方还没提交。此时它已经提交，用一条新语句重新读出来即可
+            row = await db.select([db.false().label('checked_in'), table.c.checkin_count, table.c.impression]) \
+                .where((table.c.user_qq == user_qq) & (table.c.belonging_group == belonging_group)) \
+                .gino.first()
+        return row
+
+
+class GroupUserSnapshot(NamedTuple):
+    'An immutable copy of a group user, safe to cache and cheap to send to worker processes.'
+    user_qq: int
+    belonging_group: int
+    checkin_count: int
+    checkin_time_last: datetime
+    impression: float
+
+    @classmethod
+    def of(cls, user: Optional[GroupUser], user_qq: int, belonging_group: int) -> 'GroupUserSnapshot':
+        'Copies the user, or makes a "never checked in" user if it does not exist.'
+        if user is None:
+            return cls(user_qq, belonging_group, 0, datetime.min, 0.0)
+        return cls(user.user_qq, user.belonging_group, user.checkin_count, user.checkin_time_last, user.impression)
@@ -2,9 +2,124 @@ import logging
 import os
 
 LOGGING_LEVEL = logging.INFO
+# 'text' 或 'json'（每行一个 JSON 对象，带有正在处理的用户、群与命令）
+LOGGING_FORMAT = os.environ.get('LOGGING_FORMAT', 'text')
+# 高频日志的限流：键为 logger 名，或 logger 名加模块名，值为 (平均每秒最多几条, 最多连续几条)。
+# 超出的会被丢弃，WARNING 及以上的日志不受限制
+LOGGING_RATE_LIMITS = {
+    'lucia.group_user_checkin': (5, 20),
+}
+
+# 延迟导入 Pillow、jieba、httpx 等较重的依赖，直到第一次用到它们，以缩短启动时间
+LAZY_IMPORTS = bool(os.environ.get('LAZY_IMPORTS'))
+
+# 启动时报告每个插件与模块的导入耗时，并可以把结果写到 JSON 文件中以便比较
+IMPORT_TIME_REPORT = bool(os.environ.get('IMPORT_TIME_REPORT'))
+IMPORT_TIME_REPORT_FILE = os.environ.get('IMPORT_TIME_REPORT_FILE')
 
 DATABASE_URI = os.environ['DATABASE_URI']
+# 可选的只读数据库（例如只读副本），只读的查询会发往这里
+DATABASE_READ_URI = os.environ.get('DATABASE_READ_URI')
+
+# 数据库连接池：最少、最多连接数，等待空闲连接的超时（秒），空闲多久（秒）后关闭连接，
+# 一个连接执行多少条语句后换成新连接，以及每个连接缓存的预备语句数（0 为不缓存，例如使用 pgbouncer 时）
+DB_POOL_MIN_SIZE = 2
+DB_POOL_MAX_SIZE = 10
+DB_POOL_ACQUIRE_TIMEOUT = 5
+DB_POOL_MAX_IDLE = 300
+DB_POOL_MAX_QUERIES = 50000
+DB_STATEMENT_CACHE_SIZE = 100
 
 PROCESSPOOL_SIZE = 3
+# 进程池最多接受多少个未完成的任务，每个任务的超时（秒），以及工作进程做完多少个任务后更换
+PROCESSPOOL_MAX_QUEUE = 16
+PROCESSPOOL_JOB_TIMEOUT = 20
+PROCESSPOOL_RECYCLE_AFTER = 500
 
 RESOURCES_DIR = 'resources'
+
+# 命令调用计数的写回策略：每隔多少秒，或累计多少次调用后写入一次数据库
+COMMAND_USE_FLUSH_INTERVAL = 5
+COMMAND_USE_FLUSH_THRESHOLD = 100
+
+# 最多缓存多少个历史调用次数的查询结果（写回数据库后失效），以及一次查询最多跨越多少天
+COMMAND_USE_HISTORY_CACHE_SIZE = 64
+COMMAND_USE_HISTORY_MAX_DAYS = 3660
+
+# 每个广播订阅者最多积压的消息数，以及积压满了之后的处理方式（见 services.broadcast.TOverflow）
+BROADCAST_QUEUE_SIZE = 256
+BROADCAST_OVERFLOW = 'drop-oldest'
+
+# 在这段时间（秒）内产生的增量消息合并成一条再广播
+BROADCAST_COALESCE_DELAY = 0.2
+
+# 广播的后端：'local' 只在本进程内广播；'unix' 通过 unix socket 与同一台机器上的其他工作进程互通，
+# 以便用多个 hypercorn 工作进程运行（hypercorn -w N）。所有工作进程要使用同一个 socket 目录
+BROADCAST_BACKEND = os.environ.get('BROADCAST_BACKEND', 'local')
+BROADCAST_SOCKET_DIR = os.environ.get('BROADCAST_SOCKET_DIR', '/tmp/lucia-broadcast')
+# 每隔多少秒查找一次新的工作进程，以及发往一个工作进程、尚未发出的数据最多积压多少字节
+BROADCAST_PEER_SCAN_INTERVAL = 5
+BROADCAST_PEER_BUFFER_LIMIT = 1 << 20
+
+# grouptty 转发：在这段时间（秒）内到达的消息合并成一条发送，每条最多多少行、多少字
+GROUPTTY_BATCH_WINDOW = 1.0
+GROUPTTY_BATCH_MAX_LINES = 20
+GROUPTTY_BATCH_MAX_CHARS = 1500
+# 平均每秒最多发送几条，允许短时间内连发几条；来不及发送的消息最多积压多少条，更早的会被跳过
+GROUPTTY_SEND_RATE = 0.5
+GROUPTTY_SEND_BURST = 3
+GROUPTTY_QUEUE_SIZE = 200
+
+# 好友、加群邀请请求：在这段时间（秒）内收到的请求合并成一条发给超级用户，攒够多少条就立即发送；
+# 监控面板可以看到最近的多少条请求
+REQUEST_DIGEST_WINDOW = 60
+REQUEST_DIGEST_MAX_ITEMS = 20
+REQUEST_HISTORY_SIZE = 50
+
+# 最多缓存多少张渲染好的签到图片
+CHECKIN_IMAGE_CACHE_SIZE = 128
+
+# 渲染好的图片怎样交给 gocqhttp：不设置时以 base64 内联在消息中；'url' 时写入图片目录，
+# 由 gocqhttp 从 IMAGE_STORE_BASE_URL 下载；'file' 时直接给出文件路径（gocqhttp 要能读到同一个目录）
+IMAGE_STORE = os.environ.get('IMAGE_STORE')
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', '/tmp/lucia-images')
+IMAGE_STORE_BASE_URL = os.environ.get('IMAGE_STORE_BASE_URL', 'http://lucia:8765')
+# 图片目录最多占用多少字节，图片最久保留多少秒，以及每隔多少秒清理一次
+IMAGE_STORE_MAX_BYTES = 64 << 20
+IMAGE_STORE_MAX_AGE = 24 * 60 * 60
+IMAGE_STORE_EVICT_INTERVAL = 60
+
+# 签到时使用单条 INSERT ... ON CONFLICT 语句，而不是加锁读取再更新
+CHECKIN_USE_UPSERT = True
+
+# 好感度排行显示前几名，以及最多在内存中保留多少个群的排行
+LEADERBOARD_SIZE = 10
+LEADERBOARD_CACHE_SIZE = 256
+
+# 群用户信息的缓存大小与有效时间（秒）
+GROUP_USER_CACHE_SIZE = 4096
+GROUP_USER_CACHE_TTL = 600
+
+# 好感度排行上显示的群名片的缓存大小与有效时间（秒）
+MEMBER_NAME_CACHE_SIZE = 4096
+MEMBER_NAME_CACHE_TTL = 600
+
+# 对外 HTTP 请求：超时（秒），连接池大小，以及每个主机同时进行的请求数
+HTTP_TIMEOUT = 10
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_CONCURRENCY_PER_HOST = 4
+
+# 天气 API 的地址，测试时可以换成本地的模拟服务器
+WEATHER_API_ROOT = os.environ.get('WEATHER_API_ROOT', 'https://wttr.in')
+
+# 天气查询结果的缓存：最多缓存的城市数，有效时间，过期后仍可先返回旧结果的时间，查询失败的缓存时间（秒）
+WEATHER_CACHE_SIZE = 256
+WEATHER_CACHE_TTL = 60
+WEATHER_CACHE_STALE_TTL = 600
+WEATHER_CACHE_NEGATIVE_TTL = 10
+# 退出时把天气缓存保存到此文件，下次启动时读取。不设置表示不保存
+WEATHER_CACHE_SNAPSHOT = os.environ.get('WEATHER_CACHE_SNAPSHOT')
+
+# jieba 词典缓存所在目录，以及最多缓存多少个句子的分词结果
+JIEBA_CACHE_DIR = RESOURCES_DIR
+JIEBA_SENTENCE_CACHE_SIZE = 1024
@@ -1,6 +1,16 @@
 import asyncio
+from collections import deque
 from contextlib import contextmanager
-from typing import Any, Awaitable, Callable, Generator
+from json import dumps
+from typing import Any, Awaitable, Callable, Collection, Generator, Literal, Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from service_config import BROADCAST_QUEUE_SIZE, BROADCAST_OVERFLOW, BROADCAST_BACKEND
+from .log import logger
 
 
 # 约定所有通过队列的消息都要遵从此格式
@@ -10,32 +20,280 @@ from typing import Any, Awaitable, Callable, Generator
 # }
 TPayload = dict[str, Any]
 
-# 目前存在的消息队列，一个客户（websocket 连接）对应着一个队列
-# 键为队列，值为所监听的消息类型
-_listeners: dict[asyncio.Queue[TPayload], set[str]] = {}
+# 可用的编码方式。msgpack 是可选依赖，安装后客户端才可以选择二进制编码
+_encoders: dict[str, Callable[[TPayload], Union[str, bytes]]] = {
+    'json': lambda payload: dumps(payload, separators=(',', ':')),
+}
+if msgpack is not None:
+    _encoders['msgpack'] = msgpack.packb
+
+ENCODINGS = frozenset(_encoders)
+
+
+class Payload(dict):
+    '''A tagged message. It is shared by all subscribers, so each encoding of it is
+    computed only once no matter how many clients send it.
+    '''
+    __slots__ = ('_encoded',)
+
+    def encode(self, encoding: str = 'json') -> Union[str, bytes]:
+        try:
+            encoded = self._encoded
+        except AttributeError:
+            encoded = self._encoded = {}
+        if (re := encoded.get(encoding)) is None:
+            re = encoded[encoding] = _encoders[encoding](self)
+        return re
+
+
+# 队列满时的处理方式：
+#   drop-oldest  丢弃最旧的消息
+#   drop-newest  丢弃新来的消息
+#   coalesce     丢弃队列中已经过时的快照：订阅时指定哪些类型的消息是完整快照（例如 messageLoad），
+#                优先丢弃与新消息同类型的、否则最旧的快照。增量消息（例如 pluginUsage）丢了会让客户端的
+#                状态出错，所以队列中没有快照可丢时，新来的快照被丢弃，新来的增量则断开这个订阅者
+#   disconnect   断开这个订阅者，下一次接收时抛出 SlowConsumerError
+TOverflow = Literal['drop-oldest', 'drop-newest', 'coalesce', 'disconnect']
+
+
+class SlowConsumerError(Exception):
+    'Raised on receiving from a subscription that was disconnected for falling behind.'
+
+
+class Subscription:
+    'A bounded message queue of a single subscriber. Call it to receive the next message.'
+
+    def __init__(self, types: tuple[str, ...], maxsize: int, overflow: TOverflow, snapshots: Collection[str] = ()) -> None:
+        self.types = types
+        self.maxsize = maxsize
+        self.overflow = overflow
+        # 每条都是完整快照、只需保留最新一条的类型，用于 coalesce
+        self.snapshots = frozenset(snapshots)
+        # 因为队列满而被丢弃的消息数
+        self.dropped = 0
+        self.closed = False
+        self._items: deque[Payload] = deque()
+        self._ready = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def __call__(self) -> Payload:
+        while True:
+            if self.closed:
+                raise SlowConsumerError(f'subscriber of {self.types} fell behind')
+            if self._items:
+                return self._items.popleft()
+            self._ready.clear()
+            await self._ready.wait()
+
+    def put(self, payload: Payload):
+        if self.closed:
+            return
+        if len(self._items) >= self.maxsize:
+            self.dropped += 1
+            if self.overflow == 'drop-newest':
+                return
+            elif self.overflow == 'disconnect':
+                self._disconnect()
+                return
+            elif self.overflow == 'coalesce':
+                if not self._remove_stale_snapshot(payload['type']):
+                    if payload['type'] not in self.snapshots:
+                        self._disconnect()
+                    return
+            else:
+                self._items.popleft()
+        self._items.append(payload)
+        self._ready.set()
+
+    def _disconnect(self):
+        logger.warning(f'Subscriber of {self.types} disconnected: queue is full.')
+        self.closed = True
+        self._items.clear()
+        self._ready.set()
+
+    def _remove_stale_snapshot(self, type_: str) -> bool:
+        first = None
+        for i, item in enumerate(self._items):
+            if item['type'] == type_ and type_ in self.snapshots:
+                del self._items[i]
+                return True
+            if first is None and item['type'] in self.snapshots:
+                first = i
+        if first is None:
+            return False
+        del self._items[first]
+        return True
+
+
+# 按消息类型索引的订阅者，一个客户（websocket 连接）对应着一个订阅
+# 键为消息类型，值为订阅了此类型的订阅。没有订阅者的类型不会出现在这里
+_listeners: dict[str, set[Subscription]] = {}
+
+
+class LocalBackend:
+    '''Carries broadcasts to other worker processes. This default one has no other processes to
+    talk to; see `services.broadcast_unix` for one that does.
+    '''
+    clustered = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def publish(self, payload: Payload):
+        'Sends the payload to the other processes that listen to its type.'
+
+    def share_counts(self, channel: str, data: Any):
+        'Sends counts to all other processes, to be added to theirs.'
+
+    def has_remote_subscribers(self, type_: str) -> bool:
+        return False
+
+    def interest_changed(self):
+        'Called when a type gets its first subscriber or loses its last one in this process.'
+
+
+_backend = LocalBackend()
+
+# 其他工作进程分享过来的计数的处理函数，键为频道名
+_count_handlers: dict[str, Callable[[Any], None]] = {}
 
 
 @contextmanager
-def listen_to_broadcasts(*types: str) -> Generator[Callable[[], Awaitable[TPayload]], None, None]:
-    'Returns a callable that when called, receives new messages.'
-    queue = asyncio.Queue()
-    _listeners[queue] = set(types)
+def listen_to_broadcasts(
+    *types: str,
+    maxsize: int = BROADCAST_QUEUE_SIZE,
+    overflow: TOverflow = BROADCAST_OVERFLOW,
+    snapshots: Collection[str] = (),
+) -> Generator[Subscription, None, None]:
+    '''Returns a callable that when called, receives new messages. `snapshots` names the types whose
+    messages each carry the full state, which the 'coalesce' overflow may drop.
+    '''
+    sub = Subscription(types, maxsize, overflow, snapshots)
+    new_types = False
+    for type_ in types:
+        if type_ not in _listeners:
+            new_types = True
+        _listeners.setdefault(type_, set()).add(sub)
+    if new_types:
+        _backend.interest_changed()
     try:
-        yield queue.get
+        yield sub
     finally:
-        _listeners.pop(queue)
+        gone_types = False
+        for type_ in types:
+            subs = _listeners.get(type_)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del _listeners[type_]
+                    gone_types = True
+        if gone_types:
+            _backend.interest_changed()
+
+
+def has_subscribers(type_: str) -> bool:
+    'Checks cheaply whether anyone (in any worker process) listens to this type, so producers can skip the work.'
+    return type_ in _listeners or _backend.has_remote_subscribers(type_)
+
+
+def local_types() -> frozenset[str]:
+    'Gets the types that someone in this process listens to.'
+    return frozenset(_listeners)
+
+
+def get_subscriptions() -> set[Subscription]:
+    'Gets all current subscriptions, e.g. to inspect their queue lengths and drop counters.'
+    return { sub for subs in _listeners.values() for sub in subs }
+
+
+async def broadcast(type_: str, data_lazy: Callable[[], Awaitable[Any]], shared: bool = False):
+    '''Tag and broadcast messages to all current subscribers in this process. If `shared`, also to
+    those in the other worker processes; the data must then be JSON serializable. Reports that each
+    process makes of its own state (e.g. its render pool) should not be shared.
+    '''
+    if type_ not in _listeners and not (shared and _backend.has_remote_subscribers(type_)):
+        return
+    payload = as_payload(type_, await data_lazy())
+    if shared:
+        _backend.publish(payload)
+    deliver(payload)
+
+
+def deliver(payload: Payload):
+    'Puts the payload into the queues of the subscribers of its type in this process.'
+    # 等待数据期间订阅者可能有增减，所以在这里才取
+    for sub in _listeners.get(payload['type'], ()):
+        sub.put(payload)
+
 
+def is_clustered() -> bool:
+    'Whether broadcasts and counts are shared with other worker processes.'
+    return _backend.clustered
 
-async def broadcast(type_: str, data_lazy: Callable[[], Awaitable[Any]]):
-    'Tag and broadcast messages to all current subscribers.'
-    qs = [queue for queue, types in _listeners.items() if type_ in types]
-    if qs:
-        payload = as_payload(type_, await data_lazy())
-        await asyncio.gather(*[queue.put(payload) for queue in qs])
 
+def share_counts(channel: str, data: Any):
+    'Sends counts (JSON serializable) to the other worker processes, where the handler of the channel adds them up.'
+    _backend.share_counts(channel, data)
 
-def as_payload(type_: str, data: Any) -> TPayload:
+
+def on_shared_counts(channel: str):
+    'Decorator to register the handler of counts shared by the other worker processes on a channel.'
+    def decorator(func: Callable[[Any], None]) -> Callable[[Any], None]:
+        _count_handlers[channel] = func
+        return func
+    return decorator
+
+
+def receive_counts(channel: str, data: Any):
+    'Hands counts shared by another worker process to the handler of the channel.'
+    if (handler := _count_handlers.get(channel)) is not None:
+        handler(data)
+
+
+def broadcast_every_second(
+    type_: str,
+    data_lazy: Callable[[], Awaitable[Any]],
+    on_tick: Optional[Callable[[], None]] = None,
+):
+    '''Broadcasts a report of this process's state once a second, on the second, while anyone
+    listens to its type. `on_tick`, if given, runs every second before that, listened to or not.
+    '''
+    loop = asyncio.get_event_loop()
+    def _service():
+        if on_tick is not None:
+            on_tick()
+        if has_subscribers(type_):
+            asyncio.create_task(broadcast(type_, data_lazy))
+        loop.call_at(int(loop.time()) + 1, _service)
+
+    _service()
+
+
+def as_payload(type_: str, data: Any) -> Payload:
     'Wrap a result into a payload.'
-    return {
-        'type': type_, 'data': data
-    }
+    return Payload(
+        type=type_, data=data,
+    )
+
+
+async def init():
+    'Starts the broadcast backend chosen by BROADCAST_BACKEND.'
+    global _backend
+    if BROADCAST_BACKEND == 'unix':
+        from .broadcast_unix import UnixSocketBackend
+        _backend = UnixSocketBackend()
+    elif BROADCAST_BACKEND != 'local':
+        raise ValueError(f'unknown broadcast backend: {BROADCAST_BACKEND}')
+    await _backend.start()
+
+    logger.info(f'Broadcast ({BROADCAST_BACKEND}) loaded successfully!')
+
+
+async def shutdown():
+    'Stops the broadcast backend.'
+    await _backend.stop()
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import stat
+import struct
+from glob import glob
+from typing import Any, Optional
+
+from service_config import BROADCAST_SOCKET_DIR, BROADCAST_PEER_SCAN_INTERVAL, BROADCAST_PEER_BUFFER_LIMIT
+from .broadcast import LocalBackend, Payload, deliver, local_types, receive_counts
+from .log import logger
+
+
+# 每一帧：4 字节的长度（大端），1 字节的种类，然后是 JSON
+_HEADER = struct.Struct('!IB')
+
+# 帧的种类：
+#   HELLO    连接后第一帧，以及本进程订阅的类型有变化时：{ path, types }
+#   PAYLOAD  一条广播，即 Payload 本身
+#   COUNTS   分享的计数：{ channel, data }
+_HELLO, _PAYLOAD, _COUNTS = 1, 2, 3
+
+
+def _frame(kind: int, body: Any) -> bytes:
+    data = body.encode() if isinstance(body, str) else json.dumps(body, separators=(',', ':')).encode()
+    return _HEADER.pack(len(data), kind) + data
+
+
+class _Peer:
+    'Our connection to another worker process.'
+    __slots__ = ('path', 'writer', 'watcher')
+
+    def __init__(self, path: str, writer: asyncio.StreamWriter) -> None:
+        self.path = path
+        self.writer = writer
+        self.watcher: Optional[asyncio.Task] = None
+
+
+class UnixSocketBackend(LocalBackend):
+    '''Shares broadcasts with the other worker processes on this machine. Each process listens on
+    a Unix socket named after its pid in BROADCAST_SOCKET_DIR and connects to the sockets of the
+    others. Each process tells the others which types it listens to, so a payload is only sent to
+    the processes that want it. Sending never waits: a peer that falls too far behind loses frames.
+    '''
+    clustered = True
+
+    def __init__(self, directory: str = BROADCAST_SOCKET_DIR) -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, f'{os.getpid()}.sock')
+        # 因为对方积压太多而丢弃的帧数
+        self.dropped = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._scan_task: Optional[asyncio.Task] = None
+        # 我们连向其他进程的连接，键为对方的 socket 路径
+        self._peers: dict[str, _Peer] = {}
+        # 其他进程订阅的类型（由它们连向我们的连接告知），键为对方的 socket 路径
+        self._interest: dict[str, frozenset[str]] = {}
+        self._remote_types: frozenset[str] = frozenset()
+        self._hello_scheduled = False
+        self._connecting: set[str] = set()
+        # 其他进程连向我们的连接
+        self._incoming: set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        self._ensure_private_directory()
+        # 同一个 pid 的进程之前没能清理掉的 socket
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+        self._scan_task = asyncio.create_task(self._scan_loop())
+
+    def _ensure_private_directory(self):
+        # 能连上 socket 的进程就能注入广播与计数，所以目录只能由运行机器人的用户访问
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        st = os.lstat(self.directory)
+        if not stat.S_ISDIR(st.st_mode):
+            raise RuntimeError(f'Broadcast socket directory {self.directory} is not a directory.')
+        if st.st_uid != os.getuid():
+            raise RuntimeError(f'Broadcast socket directory {self.directory} is owned by another user.')
+        if st.st_mode & 0o077:
+            raise RuntimeError(f'Broadcast socket directory {self.directory} is accessible by other users; chmod it to 700.')
+
+    async def stop(self):
+        if self._scan_task is not None:
+            self._scan_task.cancel()
+        if self._server is not None:
+            self._server.close()
+        for peer in list(self._peers.values()):
+            self._drop_peer(peer)
+        for writer in list(self._incoming):
+            writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # 让接收的循环读到连接关闭后自己结束
+        await asyncio.sleep(0)
+
+    # 发送
+
+    def _send(self, peer: _Peer, frame: bytes):
+        if peer.writer.is_closing():
+            self._drop_peer(peer)
+            return
+        if peer.writer.transport.get_write_buffer_size() > BROADCAST_PEER_BUFFER_LIMIT:
+            self.dropped += 1
+            return
+        peer.writer.write(frame)
+
+    def publish(self, payload: Payload):
+        type_ = payload['type']
+        frame = None
+        for peer in list(self._peers.values()):
+            if type_ in self._interest.get(peer.path, ()):
+                # 同一条广播只编码一次
+                frame = frame or _frame(_PAYLOAD, payload.encode('json'))
+                self._send(peer, frame)
+
+    def share_counts(self, channel: str, data: Any):
+        if not self._peers:
+            return
+        frame = _frame(_COUNTS, { 'channel': channel, 'data': data })
+        for peer in list(self._peers.values()):
+            self._send(peer, frame)
+
+    def has_remote_subscribers(self, type_: str) -> bool:
+        return type_ in self._remote_types
+
+    def interest_changed(self):
+        # 同一轮事件循环里的多次变化只告知一次
+        if not self._hello_scheduled:
+            self._hello_scheduled = True
+            asyncio.get_event_loop().call_soon(self._send_hello)
+
+    def _send_hello(self):
+        self._hello_scheduled = False
+        frame = self._hello()
+        for peer in list(self._peers.values()):
+            self._send(peer, frame)
+
+    def _hello(self) -> bytes:
+        return _frame(_HELLO, { 'path': self.path, 'types': sorted(local_types()) })
+
+    # 连接其他进程
+
+    async def _scan_loop(self):
+        while True:
+            await self._scan()
+            await asyncio.sleep(BROADCAST_PEER_SCAN_INTERVAL)
+
+    async def _scan(self):
+        for path in glob(os.path.join(self.directory, '*.sock')):
+            await self._connect(path)
+
+    async def _connect(self, path: str):
+        if path == self.path or path in self._peers or path in self._connecting:
+            return
+        self._connecting.add(path)
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+        except ConnectionRefusedError:
+            # 没有进程在监听，是退出时没能清理掉的 socket
+            logger.info(f'Removing stale broadcast socket {path}.')
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return
+        except OSError:
+            return
+        finally:
+            self._connecting.discard(path)
+        peer = self._peers[path] = _Peer(path, writer)
+        peer.watcher = asyncio.create_task(self._watch(peer, reader))
+        writer.write(self._hello())
+        logger.info(f'Connected to broadcast peer {path}.')
+
+    async def _watch(self, peer: _Peer, reader: asyncio.StreamReader):
+        # 对方不会在这个连接上发送任何东西，读到结尾就说明它退出了
+        try:
+            await reader.read()
+        finally:
+            self._drop_peer(peer)
+
+    def _drop_peer(self, peer: _Peer):
+        if self._peers.get(peer.path) is peer:
+            del self._peers[peer.path]
+            logger.info(f'Disconnected from broadcast peer {peer.path}.')
+        peer.writer.close()
+        if peer.watcher is not None and peer.watcher is not asyncio.current_task():
+            peer.watcher.cancel()
+
+    # 接收其他进程发来的帧
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        path = None
+        self._incoming.add(writer)
+        try:
+            while True:
+                length, kind = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                body = json.loads(await reader.readexactly(length))
+                if kind == _HELLO:
+                    path = body['path']
+                    self._set_interest(path, frozenset(body['types']))
+                    # 新启动的进程连上了我们，不必等到下一次查找就连回去
+                    if path not in self._peers:
+                        asyncio.create_task(self._connect(path))
+                elif kind == _PAYLOAD:
+                    deliver(Payload(body))
+                elif kind == _COUNTS:
+                    receive_counts(body['channel'], body['data'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            if path is not None:
+                self._set_interest(path, None)
+            self._incoming.discard(writer)
+            writer.close()
+
+    def _set_interest(self, path: str, types: Optional[frozenset[str]]):
+        if types is None:
+            self._interest.pop(path, None)
+        else:
+            self._interest[path] = types
+        self._remote_types = frozenset().union(*self._interest.values())
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Generic, Hashable, Optional, TypeVar, Union
+
+
+_K = TypeVar('_K', bound=Hashable)
+_V = TypeVar('_V')
+
+
+# 有名字的缓存，它们的大小与命中次数由 /metrics 输出。键为名字
+_caches: dict[str, Union['LRUCache', 'StaleWhileRevalidateCache']] = {}
+
+
+def get_cache_stats() -> dict[str, dict[str, int]]:
+    'Gets the size, hits and misses of every named cache.'
+    return { name: cache.stats() for name, cache in _caches.items() }
+
+
+class LRUCache(Generic[_K, _V]):
+    'A bounded in-process cache that evicts the least recently used entry, with optional expiry.'
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None, name: Optional[str] = None) -> None:
+        if name is not None:
+            _caches[name] = self
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # 值为 (过期时刻, 数据)
+        self._data: OrderedDict[_K, tuple[float, _V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: _K) -> Optional[_V]:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: _K, value: _V):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def setdefault(self, key: _K, value: _V) -> _V:
+        'Puts the value unless a live one is already there, and returns whichever is cached.'
+        item = self._data.get(key)
+        if item is not None and item[0] >= time.monotonic():
+            return item[1]
+        self.put(key, value)
+        return value
+
+    def pop(self, key: _K):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        return { 'size': len(self._data), 'hits': self.hits, 'misses': self.misses }
+
+
+class StaleWhileRevalidateCache:
+    '''A bounded LRU cache of async results. Values older than `ttl` are still returned for up
+    to `stale_ttl` more seconds while a background refresh runs, and failures of the types in
+    `negative_exceptions` are remembered for `negative_ttl` seconds. Keys must be strings so
+    the cache can be saved to and loaded from a JSON snapshot.
+    '''
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        stale_ttl: float = 0,
+        negative_ttl: float = 0,
+        negative_exceptions: tuple[type[Exception], ...] = (),
+        name: Optional[str] = None,
+    ) -> None:
+        if name is not None:
+            _caches[name] = self
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.negative_exceptions = negative_exceptions
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        # 值为 (取得时刻, 数据, 异常)，时刻用 time.time() 以便保存到硬盘
+        self._data: OrderedDict[str, tuple[float, Any, Optional[Exception]]] = OrderedDict()
+        self._refreshing: dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        'Gets the cached value of the key, calling `fetch` to (re)load it if necessary.'
+        item = self._data.get(key)
+        if item is not None:
+            fetched_at, value, error = item
+            age = time.time() - fetched_at
+            if error is not None:
+                if age < self.negative_ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    raise error.with_traceback(None)
+            elif age < self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            elif age < self.ttl + self.stale_ttl:
+                # 先返回旧数据，同时在后台刷新
+                self._data.move_to_end(key)
+                self.stale_hits += 1
+                self._refresh(key, fetch)
+                return value
+        self.misses += 1
+        return await asyncio.shield(self._refresh(key, fetch))
+
+    def _refresh(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        if (task := self._refreshing.get(key)) is None:
+            task = self._refreshing[key] = asyncio.create_task(self._load(key, fetch))
+            task.add_done_callback(lambda t: self._refresh_done(key, t))
+        return task
+
+    def _refresh_done(self, key: str, task: asyncio.Task):
+        self._refreshing.pop(key, None)
+        # 后台刷新失败时没有人等待结果，在这里取走异常以免报错
+        if not task.cancelled():
+            task.exception()
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await fetch()
+        except self.negative_exceptions as e:
+            # 还有可用的旧数据时继续使用它，否则记住这次失败
+            item = self._data.get(key)
+            if item is None or item[2] is not None or time.time() - item[0] >= self.ttl + self.stale_ttl:
+                self._put(key, (time.time(), None, e))
+            raise
+        self._put(key, (time.time(), value, None))
+        return value
+
+    def _put(self, key: str, item: tuple[float, Any, Optional[Exception]]):
+        self._data[key] = item
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return { 'size': len(self._data), 'hits': self.hits, 'staleHits': self.stale_hits, 'misses': self.misses }
+
+    def save(self, path: str):
+        'Saves all successful values to a JSON file.'
+        snapshot = { key: [fetched_at, value] for key, (fetched_at, value, error) in self._data.items() if error is None }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+
+    def load(self, path: str):
+        'Loads values saved by `save()`, dropping those too old to be served even as stale.'
+        with open(path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        oldest = time.time() - self.ttl - self.stale_ttl
+        for key, (fetched_at, value) in sorted(snapshot.items(), key=lambda pair: pair[1][0]):
+            if fetched_at > oldest:
+                self._put(key, (fetched_at, value, None))
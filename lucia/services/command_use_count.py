@@ -1,28 +1,365 @@
 import asyncio
 import datetime
 from functools import wraps
-from typing import Awaitable, Callable, TypeVar
+from typing import Any, Awaitable, Callable, Literal, Optional, TypeVar
 
-from .db_context import db
-from .broadcast import broadcast
-from models.command_use import CommandUse
+from nonebot.command import CommandInterrupt
+from sqlalchemy.dialects.postgresql import insert
+
+from .db_context import db, read_bind
+from .broadcast import broadcast, has_subscribers, is_clustered, share_counts, on_shared_counts
+from .cache import LRUCache
+from .latency import timed
+from .log import logger, log_context
+from models.command_use import CommandUse, CommandUseRollup
+from service_config import (
+    BROADCAST_COALESCE_DELAY, COMMAND_USE_FLUSH_INTERVAL, COMMAND_USE_FLUSH_THRESHOLD,
+    COMMAND_USE_HISTORY_CACHE_SIZE, COMMAND_USE_HISTORY_MAX_DAYS,
+)
 
 
 _base_count: dict[str, int] = {}
 
+# 尚未写入数据库的调用次数，键为 (命令名, 日期)
+_pending: dict[tuple[str, datetime.date], int] = {}
+_pending_total = 0
+
+# 今日调用次数的内存快照，是今日计数的唯一来源：启动时从数据库读取一次，每次调用时增加，
+# 本地时间零点整个换成新的一天。新的仪表盘和 /metrics 都直接读取它，不必访问数据库
+_today_date = datetime.date.today()
+_today: dict[str, int] = {}
+
+# 等待广播的命令名。短时间内的多次调用合并成一条增量广播
+_dirty: set[str] = set()
+
+# 多个工作进程时，本进程的调用次数要告诉其他进程，让它们的快照也包括在内。
+# 每个进程只把自己的调用写回数据库
+_unshared: dict[str, int] = {}
+
+# 历史查询的粒度。按周、按月的查询读取预先汇总好的 command_use_rollups，每次写回时一并更新
+TGranularity = Literal['day', 'week', 'month']
+_ROLLUP_PERIODS = ('week', 'month')
+
+# 历史查询的结果。数据库里的计数只在写回时改变，所以每次写回后清空
+_history_cache: LRUCache[tuple[datetime.date, datetime.date, str], dict[str, Any]] = \
+    LRUCache(COMMAND_USE_HISTORY_CACHE_SIZE, name='command_use_history')
+# 写回的次数，用来判断查询期间是否有写回发生（这时查询结果不能缓存）
+_flush_generation = 0
+
+_lock: Optional[asyncio.Lock] = None
+_wakeup: Optional[asyncio.Event] = None
+_flush_task: Optional[asyncio.Task] = None
+
+
+def _get_lock() -> asyncio.Lock:
+    # 在事件循环中才创建，避免绑定到错误的 loop
+    global _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    return _lock
+
 
 async def get_count() -> dict[str, int]:
-    'Gets all command use counts from the database for today.'
-    today = datetime.datetime.today().date()
+    'Gets all command use counts for today. They are kept in memory, so the database is not queried.'
+    return peek_count()
+
+
+def peek_count() -> dict[str, int]:
+    'Gets all command use counts for today, like `get_count` but without awaiting.'
+    _roll_over()
+    return dict(_today)
+
+
+async def _get_count_incremental(names: tuple[str, ...]) -> dict[str, int]:
+    return { name: _today.get(name, 0) for name in names }
+
+
+async def _seed_today():
+    global _today_date, _today
+    today = datetime.date.today()
     re = await CommandUse \
         .select('name', 'use_count') \
         .where(CommandUse.date == today) \
         .gino.all()
-    return _base_count | { pair['name']: pair['use_count'] for pair in re }
+    # 读取期间已经有的调用（还没写回，所以不在结果里）也要算上
+    counts = dict.fromkeys(_base_count, 0) | { pair['name']: pair['use_count'] for pair in re }
+    if _today_date == today:
+        for name, count in _today.items():
+            counts[name] = counts.get(name, 0) + count
+    _today_date, _today = today, counts
+
+
+def _roll_over():
+    global _today_date, _today
+    today = datetime.date.today()
+    if today == _today_date:
+        return
+    # 整个换成新的字典，读取者不会看到新旧两天混在一起的计数
+    previous = _today
+    _today_date, _today = today, dict.fromkeys(_base_count.keys() | previous.keys(), 0)
+    # 尽快把前一天的计数写回，并告诉仪表盘计数归零了
+    if _wakeup is not None:
+        _wakeup.set()
+    for name in _today:
+        _schedule_broadcast(name)
+
+
+def _schedule_midnight():
+    now = datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+    asyncio.get_event_loop().call_later((midnight - now).total_seconds(), _on_midnight)
+
+
+def _on_midnight():
+    # 定时器可能比时钟稍早触发，这时 _roll_over 什么也不做，等下一次
+    _roll_over()
+    _schedule_midnight()
+
+
+def _schedule_broadcast(name: str):
+    if not has_subscribers('pluginUsage'):
+        return
+    if not _dirty:
+        asyncio.get_event_loop().call_later(BROADCAST_COALESCE_DELAY, _broadcast_dirty)
+    _dirty.add(name)
+
+
+def _broadcast_dirty():
+    names = tuple(_dirty)
+    _dirty.clear()
+    # 仅广播增量信息！
+    asyncio.create_task(broadcast('pluginUsage', lambda: _get_count_incremental(names)))
+
+
+def _period_start(date: datetime.date, granularity: str) -> datetime.date:
+    if granularity == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if granularity == 'month':
+        return date.replace(day=1)
+    return date
+
+
+def _next_period(date: datetime.date, granularity: str) -> datetime.date:
+    if granularity == 'week':
+        return date + datetime.timedelta(days=7)
+    if granularity == 'month':
+        return (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return date + datetime.timedelta(days=1)
+
+
+async def get_history(start: datetime.date, end: datetime.date, granularity: TGranularity = 'day') -> dict[str, Any]:
+    '''Gets the use counts of every command from `start` to `end` (inclusive), summed by day, week
+    or month. Weeks and months are counted whole, even if the range covers only part of them.
+    Counts that are not written to the database yet are left out. Results are cached until the
+    next write-back of any worker process. Raises `ValueError` on an invalid range or granularity.
+    '''
+    if granularity not in ('day', *_ROLLUP_PERIODS):
+        raise ValueError(f'unknown granularity: {granularity}')
+    if start > end:
+        raise ValueError('start is after end')
+    if (end - start).days >= COMMAND_USE_HISTORY_MAX_DAYS:
+        raise ValueError(f'range is longer than {COMMAND_USE_HISTORY_MAX_DAYS} days')
+
+    key = (start, end, granularity)
+    if (re := _history_cache.get(key)) is not None:
+        return re
+    generation = _flush_generation
+
+    first = _period_start(start, granularity)
+    periods: list[datetime.date] = []
+    date = first
+    while date <= end:
+        periods.append(date)
+        date = _next_period(date, granularity)
 
+    # 历史数据可以从只读数据库读取
+    if granularity == 'day':
+        rows = await read_bind().all(
+            CommandUse
+            .select('name', 'date', 'use_count')
+            .where((CommandUse.date >= start) & (CommandUse.date <= end))
+        )
+    else:
+        rows = await read_bind().all(
+            CommandUseRollup
+            .select('name', 'period_start', 'use_count')
+            .where(CommandUseRollup.period == granularity)
+            .where((CommandUseRollup.period_start >= first) & (CommandUseRollup.period_start <= end))
+        )
 
-async def _get_count_incremental(usedata: CommandUse) -> dict[str, int]:
-    return { usedata.name: usedata.use_count }
+    index = { date: i for i, date in enumerate(periods) }
+    counts: dict[str, list[int]] = {}
+    for name, date, use_count in rows:
+        counts.setdefault(name, [0] * len(periods))[index[date]] = use_count
+
+    re = {
+        'granularity': granularity,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'periods': [date.isoformat() for date in periods],
+        'counts': counts,
+    }
+    if generation == _flush_generation:
+        _history_cache.put(key, re)
+    return re
+
+
+async def _ensure_rollups():
+    # 汇总表为空（例如刚刚升级）时，从 command_uses 重新计算一遍
+    if await CommandUseRollup.query.limit(1).gino.first() is not None:
+        return
+    table = CommandUse.__table__
+    async with db.transaction():
+        for period in _ROLLUP_PERIODS:
+            # 直接写在语句里而不是作为参数，GROUP BY 才能认出它和 SELECT 中的是同一个表达式
+            period_start = db.cast(db.func.date_trunc(db.literal_column(f"'{period}'"), table.c.date), db.Date)
+            source = db.select([table.c.name, db.literal(period), period_start, db.func.sum(table.c.use_count)]) \
+                .group_by(table.c.name, period_start)
+            await db.status(
+                insert(CommandUseRollup.__table__)
+                .from_select(['name', 'period', 'period_start', 'use_count'], source)
+                .on_conflict_do_nothing()
+            )
+
+
+async def flush():
+    'Writes all pending use counts to the database in one bulk upsert.'
+    async with _get_lock():
+        await _flush_locked()
+
+
+async def _flush_locked():
+    global _pending, _pending_total
+    if not _pending:
+        return
+    flushing, _pending, _pending_total = _pending, {}, 0
+
+    table = CommandUse.__table__
+    stmt = insert(table).values([
+        { 'name': name, 'date': date, 'use_count': count }
+        for (name, date), count in flushing.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.name, table.c.date],
+        set_={ 'use_count': table.c.use_count + stmt.excluded.use_count },
+    )
+
+    # 同时累加到所在的周、月的汇总中
+    rollups: dict[tuple[str, str, datetime.date], int] = {}
+    for (name, date), count in flushing.items():
+        for period in _ROLLUP_PERIODS:
+            key = (name, period, _period_start(date, period))
+            rollups[key] = rollups.get(key, 0) + count
+    rollup_table = CommandUseRollup.__table__
+    rollup_stmt = insert(rollup_table).values([
+        { 'name': name, 'period': period, 'period_start': period_start, 'use_count': count }
+        for (name, period, period_start), count in rollups.items()
+    ])
+    rollup_stmt = rollup_stmt.on_conflict_do_update(
+        index_elements=[rollup_table.c.period, rollup_table.c.name, rollup_table.c.period_start],
+        set_={ 'use_count': rollup_table.c.use_count + rollup_stmt.excluded.use_count },
+    )
+
+    try:
+        async with db.transaction():
+            await db.status(stmt)
+            await db.status(rollup_stmt)
+    except BaseException as e:
+        # 写回失败或被取消：把计数放回去，下次再试
+        for key, count in flushing.items():
+            _pending[key] = _pending.get(key, 0) + count
+            _pending_total += count
+        if not isinstance(e, Exception):
+            raise
+        logger.exception(e)
+        return
+
+    _history_flushed()
+    # 其他工作进程缓存的历史查询结果也过时了
+    if is_clustered():
+        share_counts('commandUseFlush', None)
+
+
+def _history_flushed():
+    global _flush_generation
+    _flush_generation += 1
+    _history_cache.clear()
+
+
+@on_shared_counts('commandUseFlush')
+def _merge_flush(_):
+    _history_flushed()
+
+
+def _schedule_share(name: str):
+    if not _unshared:
+        asyncio.get_event_loop().call_later(BROADCAST_COALESCE_DELAY, _share)
+    _unshared[name] = _unshared.get(name, 0) + 1
+
+
+def _share():
+    share_counts('pluginUsage', { 'date': _today_date.isoformat(), 'counts': dict(_unshared) })
+    _unshared.clear()
+
+
+@on_shared_counts('pluginUsage')
+def _merge(data: dict[str, Any]):
+    _roll_over()
+    # 跨日前后的计数不算到新的一天里
+    if data['date'] != _today_date.isoformat():
+        return
+    for name, count in data['counts'].items():
+        _today[name] = _today.get(name, 0) + count
+        _schedule_broadcast(name)
+
+
+def _record(name: str):
+    global _pending_total
+    _roll_over()
+    _today[name] = _today.get(name, 0) + 1
+    if is_clustered():
+        _schedule_share(name)
+
+    key = (name, _today_date)
+    _pending[key] = _pending.get(key, 0) + 1
+    _pending_total += 1
+    if _pending_total >= COMMAND_USE_FLUSH_THRESHOLD and _wakeup is not None:
+        _wakeup.set()
+
+
+async def _flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), COMMAND_USE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        await flush()
+
+
+async def init():
+    'Loads today\'s use counts and starts the periodic write-back.'
+    global _wakeup, _flush_task
+    await _ensure_rollups()
+    await _seed_today()
+    _schedule_midnight()
+    _wakeup = asyncio.Event()
+    _flush_task = asyncio.create_task(_flush_loop())
+
+    logger.info('Command use count loaded successfully!')
+
+
+async def shutdown():
+    'Stops the periodic write-back and flushes whatever is left.'
+    if _flush_task is not None:
+        # 不在写回的途中取消，等它写完再停止
+        async with _get_lock():
+            _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+    await flush()
 
 
 _TAsyncFunction = TypeVar('_TAsyncFunction', bound=Callable[..., Awaitable])
@@ -30,27 +367,28 @@ _TAsyncFunction = TypeVar('_TAsyncFunction', bound=Callable[..., Awaitable])
 
 def record_successful_invocation(keyname: str):
     '''When the wrapped function exits, its today\'s use count is incremented and message
-    is broadcasted.
+    is broadcasted. The count is written to the database later in batches. How long the
+    function runs is recorded as well, whether it succeeds or not. The records it logs are
+    tagged with the command, user and group.
     '''
     _base_count[keyname] = 0
 
-    async def _post_invocation():
-        # 记录调用
-        today = datetime.datetime.today().date()
-        async with db.transaction():
-            usedata = await CommandUse.ensure(keyname, today, for_update=True)
-            await usedata.update(use_count=usedata.use_count + 1).apply()
-        # 仅广播增量信息！
-        await broadcast('pluginUsage', lambda: _get_count_incremental(usedata))
-
     def decorator(f: _TAsyncFunction) -> _TAsyncFunction:
         @wraps(f)
         async def wrapped(*args, **kwargs):
-            # 运行要调用被装饰的命令处理器
-            result = await f(*args, **kwargs)
-            # 然后做记录
-            asyncio.create_task(_post_invocation())
+            # 运行要调用被装饰的命令处理器，期间的日志带上命令与发送者
+            event = getattr(args[0], 'event', None) if args else None
+            with log_context(
+                command=keyname,
+                user=getattr(event, 'user_id', None),
+                group=getattr(event, 'group_id', None),
+            ):
+                result = await f(*args, **kwargs)
+            # 然后做记录，并广播增量信息（不必等待写回数据库）
+            _record(keyname)
+            _schedule_broadcast(keyname)
             return result
-        return wrapped # type: ignore
+        # nonebot 用异常来暂停或结束命令，这些不算失败
+        return timed(keyname, expected=(CommandInterrupt,))(wrapped) # type: ignore
 
     return decorator
@@ -1,5 +1,10 @@
-from httpx import AsyncClient, HTTPError
+import asyncio
+from typing import Optional
+from urllib.parse import urlsplit
 
+import httpx
+
+from service_config import HTTP_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_CONCURRENCY_PER_HOST
 from .log import logger
 
 
@@ -13,12 +18,59 @@ class ServiceException(Exception):
         return self.args[0]
 
 
-async def fetch_text(uri: str) -> str:
-    async with AsyncClient(headers={ 'User-Agent': 'box-s-ville.luciabot' }) as client:
+# 全局共享的 HTTP 客户端，复用连接，不必每次请求都重新握手
+_client: Optional['httpx.AsyncClient'] = None
+
+# 每个主机同时进行的请求数上限
+_host_limits: dict[str, asyncio.Semaphore] = {}
+
+# 正在进行中的请求，相同的请求只发送一次，结果由所有请求者共享
+_inflight: dict[str, asyncio.Task[str]] = {}
+
+
+def _get_client() -> 'httpx.AsyncClient':
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers={ 'User-Agent': 'box-s-ville.luciabot' },
+            timeout=httpx.Timeout(HTTP_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def init():
+    'Creates the shared HTTP client.'
+    _get_client()
+
+    logger.info('HTTP client loaded successfully!')
+
+
+async def shutdown():
+    'Closes the shared HTTP client and its connections.'
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _fetch_text(uri: str) -> str:
+    host = urlsplit(uri).netloc
+    if (sem := _host_limits.get(host)) is None:
+        sem = _host_limits[host] = asyncio.Semaphore(HTTP_MAX_CONCURRENCY_PER_HOST)
+    async with sem:
         try:
-            res = await client.get(uri)
+            res = await _get_client().get(uri)
             res.raise_for_status()
-        except HTTPError as e:
+        except httpx.HTTPError as e:
             logger.exception(e)
             raise ServiceException('API 服务目前不可用')
         return res.text
+
+
+async def fetch_text(uri: str) -> str:
+    if (task := _inflight.get(uri)) is None:
+        task = _inflight[uri] = asyncio.create_task(_fetch_text(uri))
+        task.add_done_callback(lambda _: _inflight.pop(uri, None))
+    # 一个请求者被取消不应该影响其他等待同一结果的请求者
+    return await asyncio.shield(task)
@@ -1,16 +1,116 @@
+import asyncio
+import time
+from functools import partial
+from typing import Any, Optional
+
+import gino
 from gino import Gino
+from gino.dialects.asyncpg import Pool
+from sqlalchemy.schema import CreateIndex
 
-from service_config import DATABASE_URI
+from service_config import DATABASE_URI, DATABASE_READ_URI, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, \
+    DB_POOL_ACQUIRE_TIMEOUT, DB_POOL_MAX_IDLE, DB_POOL_MAX_QUERIES, DB_STATEMENT_CACHE_SIZE
+from .broadcast import broadcast_every_second
+from .latency import Histogram
 from .log import logger
 
 
 # 全局数据库连接对象
 db = Gino()
 
+# 只读查询使用的连接，没有配置只读数据库时就是 db.bind
+_read_bind: Optional['gino.GinoEngine'] = None
+
+# 各个连接池，键为 'main' 或 'read'
+_pools: dict[str, 'InstrumentedPool'] = {}
+
+
+class InstrumentedPool(Pool):
+    'The asyncpg pool of gino, which also counts waiters and times how long getting a connection takes.'
+
+    def __init__(self, url, loop, *, name: str, **kwargs) -> None:
+        super().__init__(url, loop, **kwargs)
+        _pools[name] = self
+        # 正在等待空闲连接的请求数
+        self.waiting = 0
+        self.timeouts = 0
+        self.acquire_latency = Histogram()
+
+    async def acquire(self, *, timeout=None):
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            conn = await super().acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+        self.acquire_latency.observe((time.perf_counter() - start) * 1000)
+        return conn
+
+    def get_stats(self) -> dict[str, Any]:
+        pool = self.raw_pool
+        return {
+            'size': pool.get_size(),
+            'idle': pool.get_idle_size(),
+            'max': pool.get_max_size(),
+            'inUse': pool.get_size() - pool.get_idle_size(),
+            'waiting': self.waiting,
+            'timeouts': self.timeouts,
+            'acquireP50': self.acquire_latency.quantile(0.5),
+            'acquireP99': self.acquire_latency.quantile(0.99),
+        }
+
+
+_pool_options = dict(
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    max_inactive_connection_lifetime=DB_POOL_MAX_IDLE,
+    max_queries=DB_POOL_MAX_QUERIES,
+    statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+)
+
 
 async def init():
     'Initialise psql database connection. Program must exit before the connection is freed.'
-    await db.set_bind(DATABASE_URI)
+    global _read_bind
+    await db.set_bind(DATABASE_URI, pool_class=partial(InstrumentedPool, name='main'), **_pool_options)
     await db.gino.create_all()
+    await _create_missing_indexes()
+    if DATABASE_READ_URI:
+        _read_bind = await gino.create_engine(
+            DATABASE_READ_URI, pool_class=partial(InstrumentedPool, name='read'), **_pool_options,
+        )
+
+    broadcast_every_second('dbPool', get_stats)
 
     logger.info(f'Database loaded successfully!')
+
+
+async def _create_missing_indexes():
+    # create_all 只会创建缺少的表，已经存在的表上后来新增的索引（例如 group_users_idx2）要另外创建
+    existing = { row[0] for row in await db.all("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()") }
+    for table in db.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f'Creating index {index.name}.')
+                await db.status(CreateIndex(index))
+
+
+def read_bind() -> 'gino.GinoEngine':
+    'Gets the engine for read-only queries: the read database if one is configured, otherwise the main one.'
+    return _read_bind or db.bind
+
+
+def get_pool_stats() -> dict[str, dict[str, Any]]:
+    '''Gets the state of each connection pool, `main`, and `read` if a read database is configured:
+    its size, the connections in use, the requests waiting for one and how long getting one takes.
+    Empty before connecting.
+    '''
+    return { name: pool.get_stats() for name, pool in _pools.items() }
+
+
+async def get_stats() -> dict[str, dict[str, Any]]:
+    'Same as `get_pool_stats`, for broadcasting.'
+    return get_pool_stats()
@@ -1,84 +1,205 @@
-import asyncio
 import random
 from datetime import datetime
-from io import BytesIO
-from base64 import b64encode
-
-from PIL import Image, ImageDraw, ImageFont
-
+from functools import lru_cache
 from .log import logger
+from .imports import lazy_import
 from .db_context import db
-from .processpool import processpool_executor
-from service_config import RESOURCES_DIR
-from models.group_user import GroupUser
+from .cache import LRUCache
+from .image_store import encode_image, is_available
+from .leaderboard import Ranking, get_ranking, record_impression
+from .broadcast import is_clustered, share_counts, on_shared_counts
+from .processpool import render_scheduler, on_worker_start
+from service_config import RESOURCES_DIR, CHECKIN_IMAGE_CACHE_SIZE, CHECKIN_USE_UPSERT, \
+    GROUP_USER_CACHE_SIZE, GROUP_USER_CACHE_TTL
+from models.group_user import GroupUser, GroupUserSnapshot
+
+
+# 只在工作进程中用到
+Image = lazy_import('PIL.Image')
+ImageDraw = lazy_import('PIL.ImageDraw')
+ImageFont = lazy_import('PIL.ImageFont')
+
+
+# 群用户的只读快照，签到时更新。键为 (QQ 号, 群号)
+group_user_cache: LRUCache[tuple[int, int], GroupUserSnapshot] = LRUCache(GROUP_USER_CACHE_SIZE, GROUP_USER_CACHE_TTL, name='group_user')
+
+# 渲染结果（交给 MessageSegment.image 的字符串）的缓存，键为图片上显示的所有信息
+_image_cache: LRUCache[tuple, str] = LRUCache(CHECKIN_IMAGE_CACHE_SIZE, name='checkin_image')
 
 
 async def group_user_check_in(user_qq: int, group: int) -> str:
     'Returns string describing the result of checking in'
+    if CHECKIN_USE_UPSERT:
+        return await group_user_check_in_upsert(user_qq, group)
+    return await group_user_check_in_locking(user_qq, group)
+
+
+async def group_user_check_in_locking(user_qq: int, group: int) -> str:
+    'Checks in by locking the user row (SELECT FOR UPDATE, then UPDATE) in a transaction.'
     present = datetime.now()
     async with db.transaction():
         user = await GroupUser.ensure(user_qq, group, for_update=True)
         # 如果同一天签到过，特殊处理
         if user.checkin_time_last.date() == present.date():
-            return _handle_already_checked_in(user)
+            return _handle_already_checked_in(user.impression)
         return await _handle_check_in(user, present) # ok
 
 
-def _handle_already_checked_in(user: GroupUser) -> str:
-    return f'已经签到过啦~ 好感度：{user.impression:.2f}'
+async def group_user_check_in_upsert(user_qq: int, group: int) -> str:
+    'Checks in with a single upsert statement, i.e. one round trip and no held row lock.'
+    present = datetime.now()
+    impression_added = random.random()
+    re = await GroupUser.check_in(user_qq, group, present, impression_added)
+    if not re['checked_in']:
+        return _handle_already_checked_in(re['impression'])
+    _checked_in(GroupUserSnapshot(user_qq, group, re['checkin_count'], present, re['impression']))
+    return _handle_checked_in(user_qq, group, re['impression'], impression_added)
+
+
+def _handle_already_checked_in(impression: float) -> str:
+    return f'已经签到过啦~ 好感度：{impression:.2f}'
 
 
 async def _handle_check_in(user: GroupUser, present: datetime) -> str:
     impression_added = random.random()
     new_impression = user.impression + impression_added
-    message = random.choice((
-        '谢谢，你是个好人！',
-        '对了，来喝杯茶吗？',
-    ))
 
     await user.update(
         checkin_count=user.checkin_count + 1,
         checkin_time_last=present,
         impression=new_impression,
     ).apply()
+    _checked_in(GroupUserSnapshot.of(user, user.user_qq, user.belonging_group))
+
+    return _handle_checked_in(user.user_qq, user.belonging_group, new_impression, impression_added)
+
+
+def _checked_in(user: GroupUserSnapshot):
+    # 更新缓存的用户与排行。其他工作进程也缓存着这个用户，告诉它们一起更新
+    _apply_check_in(user)
+    if is_clustered():
+        share_counts('checkIn', [user.user_qq, user.belonging_group, user.checkin_count,
+            user.checkin_time_last.isoformat(), user.impression])
+
+
+def _apply_check_in(user: GroupUserSnapshot):
+    key = (user.user_qq, user.belonging_group)
+    # 来自其他进程的更新可能比本进程的晚到，不要用旧的覆盖新的
+    if (cached := group_user_cache.get(key)) is None or cached.checkin_count < user.checkin_count:
+        group_user_cache.put(key, user)
+    record_impression(user.user_qq, user.belonging_group, user.impression)
+
+
+@on_shared_counts('checkIn')
+def _merge(data: list):
+    user_qq, group, checkin_count, checkin_time_last, impression = data
+    _apply_check_in(GroupUserSnapshot(user_qq, group, checkin_count, datetime.fromisoformat(checkin_time_last), impression))
+
+
+def _handle_checked_in(user_qq: int, group: int, new_impression: float, impression_added: float) -> str:
+    message = random.choice((
+        '谢谢，你是个好人！',
+        '对了，来喝杯茶吗？',
+    ))
 
     # 顺便打印此事件的日志
-    logger.info(f'(USER {user.user_qq}, GROUP {user.belonging_group}) CHECKED IN successfully. score: {new_impression:.2f} (+{impression_added:.2f}).')
+    logger.info(f'(USER {user_qq}, GROUP {group}) CHECKED IN successfully. score: {new_impression:.2f} (+{impression_added:.2f}).')
 
     return f'{message} 好感度：{new_impression:.2f} (+{impression_added:.2f})'
 
 
+async def get_group_user(user_qq: int, group: int) -> GroupUserSnapshot:
+    'Gets the user through the cache. Users that never checked in are not written to the database.'
+    key = (user_qq, group)
+    if (user := group_user_cache.get(key)) is None:
+        user = GroupUserSnapshot.of(await GroupUser.find(user_qq, group), user_qq, group)
+        # 查询期间用户可能签到了，此时以签到写入的为准
+        user = group_user_cache.setdefault(key, user)
+    return user
+
+
 async def group_user_check(user_qq: int, group: int) -> str:
-    # heuristic: if users find they have never checked in they are probable to check in
-    user = await GroupUser.ensure(user_qq, group)
+    user = await get_group_user(user_qq, group)
     return '好感度：{:.2f}\n历史签到数：{}\n上次签到日期：{}'.format(
         user.impression,
         user.checkin_count,
-        user.checkin_time_last.strftime('%Y-%m-%d') if user.checkin_time_last != datetime.min else '从未',
+        user.checkin_time_last.strftime('%Y-%m-%d') if user.checkin_count else '从未',
     )
 
 
-async def group_user_check_use_b64img(user_qq: int, group: int, user_name: str) -> str:
-    'Returns the base64 image representation of the user check result.'
-    user = await GroupUser.ensure(user_qq, group)
+async def group_user_check_use_img(user_qq: int, group: int, user_name: str) -> str:
+    '''Returns the image of the user check result as the file to pass to `MessageSegment.image`
+    (see `image_store.encode_image`). Raises ServiceException when busy.
+    '''
+    user = await get_group_user(user_qq, group)
 
-    # expensive operation!
-    return await asyncio.get_event_loop().run_in_executor(
-        processpool_executor,
-        _create_user_check_b64img,
+    # 图片上的信息没有变化时，直接使用之前渲染好的图片
+    key = (user.user_qq, user.belonging_group, user_name, user.checkin_count, user.impression)
+    if (im_file := _image_cache.get(key)) is not None and is_available(im_file):
+        return im_file
+
+    # expensive operation! 同一个用户同时只渲染一张
+    im_file = await render_scheduler.run(
+        (user_qq, group),
+        _create_user_check_img,
         user_name, user,
     )
+    _image_cache.put(key, im_file)
+    return im_file
+
+
+async def group_leaderboard(user_qq: int, group: int) -> str:
+    ranking = await get_ranking(user_qq, group)
+    lines = [f'{i}. {qq} 好感度：{impression:.2f}' for i, (qq, impression) in enumerate(ranking.top, 1)]
+    return '好感度排行：\n{}\n你的排名：{}'.format(
+        '\n'.join(lines) or '还没有人签到过',
+        f'{ranking.rank} / {ranking.total}' if ranking.rank is not None else '从未签到',
+    )
+
+
+async def group_leaderboard_use_img(ranking: Ranking, names: dict[int, str]) -> str:
+    '''Returns the image of a leaderboard from `get_ranking` as the file to pass to `MessageSegment.image`.
+    `names` maps QQ numbers to the names to show. Raises ServiceException when busy.
+    '''
+    key = (ranking, tuple(names.get(qq) for qq, _ in ranking.top), names.get(ranking.user_qq))
+    if (im_file := _image_cache.get(key)) is not None and is_available(im_file):
+        return im_file
+
+    im_file = await render_scheduler.run(
+        ('leaderboard', ranking.user_qq, ranking.group),
+        _create_leaderboard_img,
+        ranking, names,
+    )
+    _image_cache.put(key, im_file)
+    return im_file
+
+
+# 以下在工作进程中运行。背景图和字体在每个进程中只加载一次
 
+@lru_cache(maxsize=None)
+def _load_background() -> 'Image.Image':
+    image = Image.open(f'{RESOURCES_DIR}/group_user_check_bg.png')
+    image.load()
+    return image
 
-def _create_user_check_b64img(user_name: str, user: GroupUser) -> str:
-    # TODO: we have a lot of byte copies. we have to optimise them.
-    bg_dir = f'{RESOURCES_DIR}/group_user_check_bg.png'
-    font_dir = f'{RESOURCES_DIR}/SourceHanSans-Regular.otf'
 
-    image = Image.open(bg_dir)
+@lru_cache(maxsize=None)
+def _load_font(size: int) -> 'ImageFont.FreeTypeFont':
+    return ImageFont.truetype(f'{RESOURCES_DIR}/SourceHanSans-Regular.otf', size)
+
+
+@on_worker_start
+def _preload_assets():
+    _load_background()
+    for size in (33, 28, 22):
+        _load_font(size)
+
+
+def _create_user_check_img(user_name: str, user: GroupUserSnapshot) -> str:
+    image = _load_background().copy()
     draw = ImageDraw.ImageDraw(image)
-    font_title = ImageFont.truetype(font_dir, 33 if len(user_name) < 8 else 28)
-    font_detail = ImageFont.truetype(font_dir, 22)
+    font_title = _load_font(33 if len(user_name) < 8 else 28)
+    font_detail = _load_font(22)
 
     txt_user = f'{user_name} ({user.user_qq})'
     draw.text((530, 65), txt_user, fill=(255, 255, 255), font=font_title, stroke_width=1, stroke_fill='#7042ad')
@@ -91,6 +212,35 @@ def _create_user_check_b64img(user_name: str, user: GroupUser) -> str:
     )
     draw.text((530, 115), txt_detail, fill=(255, 255, 255), font=font_detail, stroke_width=1, stroke_fill='#75559e')
 
-    buff = BytesIO()
-    image.save(buff, 'jpeg')
-    return b64encode(buff.getvalue()).decode()
+    return encode_image(image)
+
+
+def _create_leaderboard_img(ranking: Ranking, names: dict[int, str]) -> str:
+    background = _load_background()
+    # 背景图作为页眉，下面每一名占一行
+    row_height = 40
+    image = Image.new('RGB', (background.width, background.height + row_height * len(ranking.top) + 20), '#3b2566')
+    image.paste(background, (0, 0))
+    draw = ImageDraw.ImageDraw(image)
+    font_title = _load_font(33)
+    font_detail = _load_font(22)
+
+    draw.text((530, 65), f'群 {ranking.group} 好感度排行', fill=(255, 255, 255), font=font_title, stroke_width=1, stroke_fill='#7042ad')
+
+    user_name = names.get(ranking.user_qq, str(ranking.user_qq))
+    txt_rank = f'{ranking.rank} / {ranking.total}' if ranking.rank is not None else '从未签到'
+    txt_detail = (
+        f'{user_name}\n'
+        f'排名: {txt_rank}\n'
+        f'好感度: {ranking.impression:.02f}'
+    )
+    draw.text((530, 115), txt_detail, fill=(255, 255, 255), font=font_detail, stroke_width=1, stroke_fill='#75559e')
+
+    for i, (qq, impression) in enumerate(ranking.top):
+        y = background.height + 10 + row_height * i
+        fill = (255, 224, 130) if qq == ranking.user_qq else (255, 255, 255)
+        draw.text((40, y), f'{i + 1}.', fill=fill, font=font_detail)
+        draw.text((100, y), f'{names.get(qq, qq)} ({qq})', fill=fill, font=font_detail)
+        draw.text((800, y), f'{impression:.02f}', fill=fill, font=font_detail)
+
+    return encode_image(image)
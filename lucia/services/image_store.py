@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+from base64 import b64encode
+from hashlib import sha256
+from io import BytesIO
+from typing import Optional
+
+from service_config import IMAGE_STORE, IMAGE_STORE_DIR, IMAGE_STORE_BASE_URL, IMAGE_STORE_MAX_BYTES, \
+    IMAGE_STORE_MAX_AGE, IMAGE_STORE_EVICT_INTERVAL
+from .imports import lazy_import
+from .log import logger
+
+
+# 只用于类型标注
+Image = lazy_import('PIL.Image')
+
+
+# 图片以内容的 sha256 命名，同样的图片只保存一份，内容不会改变，可以放心地让客户端缓存
+_SUFFIX = '.jpg'
+
+_evict_timer: Optional[asyncio.TimerHandle] = None
+
+
+def is_stored_name(name: str) -> bool:
+    'Tells whether `name` looks like the file name of a stored image.'
+    digest = name[:-len(_SUFFIX)]
+    return name.endswith(_SUFFIX) and len(digest) == 64 and all(c in '0123456789abcdef' for c in digest)
+
+
+def path_of(name: str) -> str:
+    return os.path.join(IMAGE_STORE_DIR, name)
+
+
+def encode_image(image: 'Image.Image') -> str:
+    '''Encodes a rendered image as JPEG and returns what to pass to `MessageSegment.image`: the image
+    inline as base64, or with IMAGE_STORE set, the URL or path of the image written to the store.
+    Runs in the worker processes.
+    '''
+    buff = BytesIO()
+    image.save(buff, 'jpeg')
+    if not IMAGE_STORE:
+        return f'base64://{b64encode(buff.getbuffer()).decode()}'
+
+    data = buff.getbuffer()
+    name = sha256(data).hexdigest() + _SUFFIX
+    path = path_of(name)
+    if os.path.exists(path):
+        # 同样的图片已经有了，更新修改时间以免被当作旧图片清理
+        os.utime(path)
+    else:
+        os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+        # 先写入临时文件再改名，读取的一方不会看到只写了一半的图片
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    if IMAGE_STORE == 'file':
+        return f'file://{os.path.abspath(path)}'
+    return f'{IMAGE_STORE_BASE_URL}/images/{name}'
+
+
+def is_available(file: str) -> bool:
+    '''Tells whether an image from `encode_image` can still be sent, i.e. it is inline or has not been
+    evicted from the store. A stored image counts as used again and is kept longer.
+    '''
+    if file.startswith('base64://'):
+        return True
+    try:
+        os.utime(path_of(file.rsplit('/', 1)[-1]))
+    except OSError:
+        return False
+    return True
+
+
+def _evict():
+    # 先清理超过 IMAGE_STORE_MAX_AGE 的图片，然后从最久没有用到的开始清理，直到总大小不超过 IMAGE_STORE_MAX_BYTES
+    try:
+        entries = [e for e in os.scandir(IMAGE_STORE_DIR) if e.is_file()]
+    except FileNotFoundError:
+        return
+    files = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+
+    expire_before = time.time() - IMAGE_STORE_MAX_AGE
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in files:
+        if mtime >= expire_before and total <= IMAGE_STORE_MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logger.info(f'Evicted {removed} images from the image store.')
+
+
+async def init():
+    'Starts evicting old images from the store periodically.'
+    if not IMAGE_STORE:
+        return
+    loop = asyncio.get_event_loop()
+
+    async def _service():
+        global _evict_timer
+        # 扫描目录是阻塞的文件操作，放到线程里
+        try:
+            await loop.run_in_executor(None, _evict)
+        except Exception as e:
+            logger.exception(e)
+        _evict_timer = loop.call_later(IMAGE_STORE_EVICT_INTERVAL, lambda: asyncio.create_task(_service()))
+
+    await _service()
+    logger.info(f'Image store at {IMAGE_STORE_DIR} loaded successfully!')
+
+
+async def shutdown():
+    if _evict_timer is not None:
+        _evict_timer.cancel()
@@ -0,0 +1,114 @@
+import importlib
+import importlib.abc
+import importlib.util
+import json
+import sys
+import time
+from types import ModuleType
+from typing import Optional
+
+from service_config import LAZY_IMPORTS, IMPORT_TIME_REPORT, IMPORT_TIME_REPORT_FILE
+from .log import logger
+
+
+def lazy_import(name: str) -> ModuleType:
+    '''Imports a module. With `LAZY_IMPORTS` on, the module is not actually executed until
+    one of its attributes is first used, so heavy dependencies do not slow down startup.
+    Finding a submodule runs its parent package, so lazy-import the package itself and import
+    its submodules where they are used.
+    '''
+    if not LAZY_IMPORTS or name in sys.modules:
+        return importlib.import_module(name)
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    # 正常导入子模块时，子模块也会成为父模块的属性
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+# 每个模块的导入耗时：(自身耗时, 包含其导入的其他模块在内的总耗时)，单位为秒
+_import_times: dict[str, tuple[float, float]] = {}
+# 正在导入的模块栈，记录每一层中嵌套导入所花的时间
+_nested_times: list[float] = []
+
+
+class _TimingLoader(importlib.abc.Loader):
+    def __init__(self, loader: importlib.abc.Loader) -> None:
+        self._loader = loader
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module: ModuleType):
+        # 模块自己看到的仍然是原来的 loader
+        module.__loader__ = module.__spec__.loader = self._loader
+        _nested_times.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = _nested_times.pop()
+            if _nested_times:
+                _nested_times[-1] += elapsed
+            _import_times[module.__name__] = (elapsed - nested, elapsed)
+
+
+class _TimingFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimingLoader(spec.loader)
+                return spec
+        return None
+
+
+_finder: Optional[_TimingFinder] = None
+
+
+def install_import_timer():
+    'Starts timing all imports from now on, if `IMPORT_TIME_REPORT` is on.'
+    global _finder
+    if IMPORT_TIME_REPORT and _finder is None:
+        _finder = _TimingFinder()
+        sys.meta_path.insert(0, _finder)
+
+
+def report_import_times(plugin_prefix: str, top: int = 15):
+    'Stops timing imports and reports the cost of each plugin and the slowest modules.'
+    global _finder
+    if _finder is None:
+        return
+    sys.meta_path.remove(_finder)
+    _finder = None
+
+    plugins = {
+        name: total for name, (_, total) in _import_times.items()
+        if name.startswith(f'{plugin_prefix}.')
+    }
+    modules = sorted(_import_times.items(), key=lambda pair: pair[1][0], reverse=True)
+
+    logger.info(f'Imported {len(_import_times)} modules in {sum(t for t, _ in _import_times.values()):.3f}s.')
+    for name, total in sorted(plugins.items(), key=lambda pair: pair[1], reverse=True):
+        logger.info(f'  plugin {name}: {total * 1000:.1f}ms')
+    for name, (self_time, total) in modules[:top]:
+        logger.info(f'  module {name}: {self_time * 1000:.1f}ms (cumulative {total * 1000:.1f}ms)')
+
+    if IMPORT_TIME_REPORT_FILE:
+        with open(IMPORT_TIME_REPORT_FILE, 'w') as f:
+            json.dump({
+                'plugins': plugins,
+                'modules': { name: { 'self': self_time, 'cumulative': total } for name, (self_time, total) in modules },
+            }, f, indent=2)
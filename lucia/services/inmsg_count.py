@@ -1,46 +1,187 @@
-import asyncio
-from datetime import datetime
-from typing import Optional
+import heapq
+import time
+from collections import deque
+from typing import Any, Optional
 
-from .broadcast import broadcast
+from .broadcast import broadcast_every_second, is_clustered, share_counts, on_shared_counts
 from .log import logger
 
 
-_counts = [0 for _ in range(61)]
+class _Ring:
+    'Fixed-width time buckets with a running total. The slot at `pos` is being filled.'
+    __slots__ = ('slots', 'pos', 'total', 'cumulative')
 
-_epoch = datetime.now()
+    def __init__(self, size: int) -> None:
+        self.slots = [0] * size
+        self.pos = 0
+        self.total = 0
+        # 从启动开始的总数，不会因为走秒而减少
+        self.cumulative = 0
 
+    def add(self, n: int = 1):
+        self.slots[self.pos] += n
+        self.total += n
+        self.cumulative += n
 
-def _get_offset() -> int:
-    return int((datetime.now() - _epoch).total_seconds()) % 61
+    def merge(self, n: int):
+        # 其他工作进程的计数，不算进本进程自启动以来的总数
+        self.slots[self.pos] += n
+        self.total += n
 
+    def current(self) -> int:
+        return self.slots[self.pos]
 
-async def get_count(curr_s: Optional[int] = None) -> dict[str, int]:
-    'Gets report that counts number of messages received in last 60s and last second.'
-    if curr_s is None:
-        curr_s = _get_offset()
+    def previous(self) -> int:
+        return self.slots[self.pos - 1] # note [-1] indexes to the last slot!
+
+    def advance(self):
+        # 移到下一格，并归零其中的旧计数
+        self.pos = (self.pos + 1) % len(self.slots)
+        self.total -= self.slots[self.pos]
+        self.slots[self.pos] = 0
+
+    def series(self) -> list[int]:
+        'Gets completed buckets, oldest first.'
+        return self.slots[self.pos + 1:] + self.slots[:self.pos]
+
+
+# 三种分辨率：每秒（1 分钟），每分钟（1 小时），每 5 分钟（24 小时）
+# 只有秒级计数在收到消息时更新，每过一秒再把这一秒的计数汇总到粗粒度的计数中
+_seconds = _Ring(61)
+_minutes = _Ring(60)
+_five_minutes = _Ring(24 * 12)
+
+# 按消息类型（group、private 等）的秒级计数，类型很少，第一次见到时创建
+_by_type: dict[str, _Ring] = {}
+
+# 按群的计数：当前这一秒的计数，过去 60 秒每秒的计数，以及它们的总和
+_by_group_now: dict[int, int] = {}
+_by_group_history: deque[dict[int, int]] = deque()
+_by_group_total: dict[int, int] = {}
+
+# 多个工作进程时，本进程在这一秒内收到、还没有分享给其他进程的消息数：按类型，以及按群
+_unshared_by_type: dict[str, int] = {}
+_unshared_by_group: dict[int, int] = {}
+_sharing = False
+
+# 已经走过的秒数，以及上一次走秒时单调时钟的读数
+_ticks = 0
+_last_tick = 0
+
+
+def _tick_once():
+    global _ticks, _by_group_now
+    closing = _seconds.current()
+    _minutes.add(closing)
+    _five_minutes.add(closing)
+
+    _ticks += 1
+    _seconds.advance()
+    if _ticks % 60 == 0:
+        _minutes.advance()
+    if _ticks % 300 == 0:
+        _five_minutes.advance()
+    for ring in _by_type.values():
+        ring.advance()
+
+    if len(_by_group_history) == 60:
+        for group, n in _by_group_history.popleft().items():
+            if (left := _by_group_total[group] - n):
+                _by_group_total[group] = left
+            else:
+                del _by_group_total[group]
+    _by_group_history.append(_by_group_now)
+    _by_group_now = {}
+
+
+def _tick():
+    global _last_tick
+    now = int(time.monotonic())
+    # 计时器可能会迟到，落下几秒就补走几秒（最多一天）
+    for _ in range(min(now - _last_tick, 86400)):
+        _tick_once()
+    _last_tick = now
+
+
+async def get_count() -> dict[str, Any]:
+    'Gets report that counts number of messages received in several time ranges.'
     return {
-        'lastMin': sum(_counts),
-        'lastSec': _counts[curr_s - 1], # note [-1] indexes to [60]!
+        'lastMin': _seconds.total,
+        'lastSec': _seconds.previous(),
+        'lastHour': _minutes.total,
+        'lastDay': _five_minutes.total,
+        'perSecond': _seconds.series(),
+        'perMinute': _minutes.series(),
+        'perFiveMinutes': _five_minutes.series(),
+        'byType': { type_: ring.total for type_, ring in _by_type.items() },
+        # 只报告最活跃的群
+        'byGroup': dict(heapq.nlargest(10, _by_group_total.items(), key=lambda pair: pair[1])),
     }
 
 
-async def increase_now():
-    _counts[_get_offset()] += 1
+def get_last_minute() -> int:
+    'Gets the number of messages received in the last minute.'
+    return _seconds.total
+
+
+def get_totals() -> dict[str, int]:
+    'Gets the number of messages received of each type since the start, by this process only.'
+    return { type_: ring.cumulative for type_, ring in _by_type.items() }
+
+
+def increase_now(message_type: str, group_id: Optional[int] = None):
+    _seconds.add()
+
+    if (ring := _by_type.get(message_type)) is None:
+        ring = _by_type[message_type] = _Ring(61)
+    ring.add()
+
+    if group_id:
+        _by_group_now[group_id] = _by_group_now.get(group_id, 0) + 1
+        _by_group_total[group_id] = _by_group_total.get(group_id, 0) + 1
+
+    if _sharing:
+        _unshared_by_type[message_type] = _unshared_by_type.get(message_type, 0) + 1
+        if group_id:
+            _unshared_by_group[group_id] = _unshared_by_group.get(group_id, 0) + 1
+
+
+def _share():
+    if not _unshared_by_type:
+        return
+    share_counts('messageLoad', { 'byType': _unshared_by_type, 'byGroup': _unshared_by_group })
+    _unshared_by_type.clear()
+    _unshared_by_group.clear()
+
+
+@on_shared_counts('messageLoad')
+def _merge(data: dict[str, dict[str, int]]):
+    # 其他工作进程上一秒收到的消息，算在这一秒里
+    for message_type, n in data['byType'].items():
+        _seconds.merge(n)
+        if (ring := _by_type.get(message_type)) is None:
+            ring = _by_type[message_type] = _Ring(61)
+        ring.merge(n)
+    for group, n in data['byGroup'].items():
+        # JSON 的键是字符串
+        group_id = int(group)
+        _by_group_now[group_id] = _by_group_now.get(group_id, 0) + n
+        _by_group_total[group_id] = _by_group_total.get(group_id, 0) + n
 
 
 async def init():
-    'Kickstarts the message counting service (removing old counts) and brocasting.'
-    loop = asyncio.get_event_loop()
-    def _service():
-        curr_s = _get_offset()
-        # 归零第 61 秒前的计数
-        _counts[curr_s + 1 if curr_s != 60 else 0] = 0
-        # 把计数消息广播出去，然后等一秒钟再继续这个循环
-        # logger.info('reset')  # 取消试试
-        asyncio.create_task(broadcast('messageLoad', lambda: get_count(curr_s)))
-        loop.call_at(int(loop.time()) + 1, _service)
-
-    _service()
+    '''Kickstarts the message counting service (removing old counts) and broadcasting. With multiple
+    worker processes, they share their counts every second so that each reports the total of all.
+    '''
+    global _last_tick, _sharing
+    _last_tick = int(time.monotonic())
+    _sharing = is_clustered()
+    def _on_tick():
+        if _sharing:
+            _share()
+        _tick()
+
+    # 每秒移除过期的计数，然后把计数消息广播出去
+    broadcast_every_second('messageLoad', get_count, _on_tick)
 
     logger.info('Message load count loaded successfully!')
@@ -0,0 +1,100 @@
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from .broadcast import broadcast_every_second
+from .log import logger
+
+
+# 直方图各个桶的上界（毫秒），最后一个桶没有上界
+_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    'Counts of durations in fixed buckets, plus the number of failed runs.'
+    __slots__ = ('counts', 'total', 'failures')
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.total = 0
+        self.failures = 0
+
+    def observe(self, ms: float, ok: bool = True):
+        self.counts[bisect_left(_BUCKETS, ms)] += 1
+        self.total += 1
+        if not ok:
+            self.failures += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        'Estimates the q-quantile in ms, interpolating linearly inside the bucket.'
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = _BUCKETS[i - 1] if i else 0
+                if i == len(_BUCKETS):
+                    return lower
+                return lower + (_BUCKETS[i] - lower) * (rank - seen) / count
+            seen += count
+        return _BUCKETS[-1]
+
+
+# 键为命令名或消息预处理器名
+_histograms: dict[str, Histogram] = {}
+
+
+def observe(name: str, seconds: float, ok: bool = True):
+    'Records one run of the handler.'
+    if (hist := _histograms.get(name)) is None:
+        hist = _histograms[name] = Histogram()
+    hist.observe(seconds * 1000, ok)
+
+
+_TAsyncFunction = TypeVar('_TAsyncFunction', bound=Callable[..., Awaitable])
+
+
+def timed(name: str, expected: tuple[type[BaseException], ...] = ()):
+    '''Records how long the wrapped handler runs, including when it fails. Exceptions of the
+    `expected` types are control flow (e.g. nonebot's command interruptions), not failures.
+    '''
+    def decorator(f: _TAsyncFunction) -> _TAsyncFunction:
+        @wraps(f)
+        async def wrapped(*args, **kwargs):
+            ok = False
+            start = time.perf_counter()
+            try:
+                result = await f(*args, **kwargs)
+                ok = True
+                return result
+            except expected:
+                ok = True
+                raise
+            finally:
+                observe(name, time.perf_counter() - start, ok)
+        return wrapped # type: ignore
+
+    return decorator
+
+
+async def get_report() -> dict[str, dict[str, Any]]:
+    'Gets p50/p95/p99 (ms), run count and failure count of every handler.'
+    return {
+        name: {
+            'count': hist.total,
+            'failures': hist.failures,
+            'p50': hist.quantile(0.5),
+            'p95': hist.quantile(0.95),
+            'p99': hist.quantile(0.99),
+        }
+        for name, hist in _histograms.items()
+    }
+
+
+async def init():
+    'Kickstarts broadcasting of the handler latency report.'
+    broadcast_every_second('handlerLatency', get_report)
+
+    logger.info('Handler latency loaded successfully!')
@@ -0,0 +1,105 @@
+import asyncio
+from bisect import bisect_right, insort
+from typing import NamedTuple, Optional
+
+from .cache import LRUCache
+from models.group_user import GroupUser
+from service_config import LEADERBOARD_SIZE, LEADERBOARD_CACHE_SIZE
+
+
+class Ranking(NamedTuple):
+    'The top users of a group, and where one user stands. `rank` is None if they never checked in.'
+    group: int
+    top: tuple[tuple[int, float], ...]
+    user_qq: int
+    rank: Optional[int]
+    impression: float
+    total: int
+
+
+class GroupLeaderboard:
+    '''Impressions of every user of a group, sorted so that a rank is a binary search, plus the
+    top K users kept up to date on every check-in. Impressions only ever grow, so a user never
+    falls out of the top K by their own check-in, only by being overtaken.
+    '''
+
+    def __init__(self, size: int, impressions: list[tuple[int, float]]) -> None:
+        self.size = size
+        # 升序排列的所有好感度，以及每个用户当前的好感度
+        self._scores = sorted(impression for _, impression in impressions)
+        self._impressions = dict(impressions)
+        # 前 K 名的 (-好感度, QQ 号)，升序排列即好感度从高到低
+        self._top = sorted((-impression, user_qq) for user_qq, impression in impressions)[:size]
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def update(self, user_qq: int, impression: float):
+        old = self._impressions.get(user_qq)
+        # 加载期间发生的签到会再应用一次，已经包括在内的就跳过
+        if old is not None and impression <= old:
+            return
+        if old is not None:
+            del self._scores[bisect_right(self._scores, old) - 1]
+        insort(self._scores, impression)
+        self._impressions[user_qq] = impression
+
+        if len(self._top) < self.size or -impression < self._top[-1][0]:
+            self._top = [entry for entry in self._top if entry[1] != user_qq]
+            insort(self._top, (-impression, user_qq))
+            del self._top[self.size:]
+
+    def rank_of(self, user_qq: int) -> Optional[int]:
+        'Gets the 1-based rank of the user. Users with the same impression share a rank.'
+        if (impression := self._impressions.get(user_qq)) is None:
+            return None
+        return len(self._scores) - bisect_right(self._scores, impression) + 1
+
+    def ranking(self, group: int, user_qq: int) -> Ranking:
+        return Ranking(
+            group,
+            tuple((qq, -neg_impression) for neg_impression, qq in self._top),
+            user_qq,
+            self.rank_of(user_qq),
+            self._impressions.get(user_qq, 0.0),
+            len(self._scores),
+        )
+
+
+# 已加载的各群排行，键为群号。签到时在这里更新，所以不会过期
+_leaderboards: LRUCache[int, GroupLeaderboard] = LRUCache(LEADERBOARD_CACHE_SIZE, name='leaderboard')
+
+# 正在加载的群，值为加载期间发生的签到。加载完成后再应用一遍，以免丢失
+_loading: dict[int, list[tuple[int, float]]] = {}
+_load_tasks: dict[int, asyncio.Task[GroupLeaderboard]] = {}
+
+
+def record_impression(user_qq: int, group: int, impression: float):
+    'Updates the leaderboard of the group, if it is loaded, after the user checked in.'
+    if (board := _leaderboards.get(group)) is not None:
+        board.update(user_qq, impression)
+    elif (updates := _loading.get(group)) is not None:
+        updates.append((user_qq, impression))
+
+
+async def _load(group: int) -> GroupLeaderboard:
+    _loading[group] = []
+    try:
+        board = GroupLeaderboard(LEADERBOARD_SIZE, await GroupUser.impressions_of_group(group))
+        for user_qq, impression in _loading[group]:
+            board.update(user_qq, impression)
+    finally:
+        del _loading[group]
+    _leaderboards.put(group, board)
+    return board
+
+
+async def get_ranking(user_qq: int, group: int) -> Ranking:
+    'Gets the top users of the group and the rank of the user. The group is loaded once, then kept in memory.'
+    if (board := _leaderboards.get(group)) is None:
+        # 同一个群同时只加载一次
+        if (task := _load_tasks.get(group)) is None:
+            task = _load_tasks[group] = asyncio.create_task(_load(group))
+            task.add_done_callback(lambda _: _load_tasks.pop(group, None))
+        board = await asyncio.shield(task)
+    return board.ranking(group, user_qq)
@@ -1,13 +1,122 @@
+import atexit
+import json
 import logging
+import os
+import queue
 import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
 
-from service_config import LOGGING_LEVEL
+from service_config import LOGGING_LEVEL, LOGGING_FORMAT, LOGGING_RATE_LIMITS
+from .ratelimit import TokenBucket
 
-_handler = logging.StreamHandler(sys.stdout)
-_handler.setFormatter(
+
+# 当前正在处理的用户、群与命令等，附加到这期间的每一条日志上
+_context: ContextVar[dict[str, Any]] = ContextVar('log_context', default={})
+
+
+@contextmanager
+def log_context(**fields):
+    'Attaches the fields (e.g. user, group, command) to the records logged inside the block.'
+    token = _context.set({ **_context.get(), **fields })
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        # 在记录日志的协程里运行，之后写出日志的线程里已经没有这个上下文了
+        if not hasattr(record, 'context'):
+            record.context = _context.get()
+        return True
+
+
+class _RateLimitFilter(logging.Filter):
+    '''Lets through at most the configured rate of records per logger name, or per logger name plus
+    module (e.g. 'lucia.group_user_checkin'). Warnings and errors are never dropped.
+    '''
+
+    def __init__(self, limits: dict[str, tuple[float, int]]) -> None:
+        super().__init__()
+        self._buckets = { key: TokenBucket(rate, burst) for key, (rate, burst) in limits.items() }
+        self._suppressed = dict.fromkeys(limits, 0)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self._buckets:
+            return True
+        key = f'{record.name}.{record.module}'
+        if (bucket := self._buckets.get(key)) is None:
+            key = record.name
+            if (bucket := self._buckets.get(key)) is None:
+                return True
+        if not bucket.try_acquire():
+            self._suppressed[key] += 1
+            return False
+        # 告知这期间有多少条被丢弃了
+        if suppressed := self._suppressed[key]:
+            self._suppressed[key] = 0
+            record.msg = f'{record.getMessage()} ({suppressed} similar records suppressed)'
+            record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    'Formats each record as one line of JSON, with the fields from `log_context`.'
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'context', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 参数之后可能会被修改，所以现在就合并成消息；格式化（包括异常的调用栈）留给写日志的线程
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# 格式化和写入 stdout 可能很慢（例如 docker-compose 下的管道），在单独的线程里进行，不阻塞事件循环
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(
+    JsonFormatter() if LOGGING_FORMAT == 'json' else
     logging.Formatter('[%(asctime)s %(name)s] %(levelname)s: %(message)s')
 )
 
+_queue_handler = _QueueHandler(queue.SimpleQueue())
+_queue_handler.addFilter(_RateLimitFilter(LOGGING_RATE_LIMITS))
+_queue_handler.addFilter(_ContextFilter())
+
+_listener = QueueListener(_queue_handler.queue, _stream_handler, respect_handler_level=True)
+_listener.start()
+# 退出前写完队列中剩下的日志
+atexit.register(_listener.stop)
+
+
+def _log_directly():
+    # fork 出来的工作进程（进程池）里没有写日志的线程，也没有事件循环，直接写出即可
+    for f in _queue_handler.filters:
+        _stream_handler.addFilter(f)
+    logger.removeHandler(_queue_handler)
+    logger.addHandler(_stream_handler)
+    atexit.unregister(_listener.stop)
+
+os.register_at_fork(after_in_child=_log_directly)
+
+
 logger = logging.getLogger('lucia')
-logger.addHandler(_handler)
+logger.addHandler(_queue_handler)
 logger.setLevel(LOGGING_LEVEL)
@@ -0,0 +1,104 @@
+import asyncio
+from collections import defaultdict
+from typing import Iterable, Union
+
+from . import command_use_count, db_context, inmsg_count, processpool
+from .broadcast import get_subscriptions
+from .cache import get_cache_stats
+from .log import logger
+
+
+# 事件循环的延迟：定时器实际触发的时刻比预定的晚了多少秒
+_loop_lag = 0.0
+_loop_lag_max = 0.0
+
+_TSample = tuple[dict[str, str], Union[int, float]]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _metric(lines: list[str], name: str, type_: str, help_: str, samples: Iterable[_TSample]):
+    lines.append(f'# HELP {name} {help_}')
+    lines.append(f'# TYPE {name} {type_}')
+    for labels, value in samples:
+        if labels:
+            label_str = ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+            lines.append(f'{name}{{{label_str}}} {value}')
+        else:
+            lines.append(f'{name} {value}')
+
+
+def render() -> str:
+    'Renders current metrics in the Prometheus text exposition format. Never queries the database.'
+    global _loop_lag_max
+    lines: list[str] = []
+
+    load = inmsg_count.get_totals()
+    _metric(lines, 'lucia_messages_received_total', 'counter', 'Messages received since start.',
+        (({ 'type': type_ }, n) for type_, n in load.items()))
+    _metric(lines, 'lucia_messages_last_minute', 'gauge', 'Messages received in the last minute.',
+        (({}, inmsg_count.get_last_minute()),))
+
+    _metric(lines, 'lucia_command_uses_today', 'gauge', 'Successful command invocations today.',
+        (({ 'command': name }, n) for name, n in command_use_count.peek_count().items()))
+
+    subscribers: dict[str, int] = defaultdict(int)
+    depths: dict[str, int] = defaultdict(int)
+    dropped: dict[str, int] = defaultdict(int)
+    for sub in get_subscriptions():
+        for type_ in sub.types:
+            subscribers[type_] += 1
+            depths[type_] += len(sub)
+            dropped[type_] += sub.dropped
+    _metric(lines, 'lucia_broadcast_subscribers', 'gauge', 'Current subscribers of each broadcast type.',
+        (({ 'type': type_ }, n) for type_, n in subscribers.items()))
+    _metric(lines, 'lucia_broadcast_queue_depth', 'gauge', 'Queued messages of subscribers of each broadcast type.',
+        (({ 'type': type_ }, n) for type_, n in depths.items()))
+    _metric(lines, 'lucia_broadcast_dropped', 'gauge', 'Messages dropped by current subscribers of each broadcast type.',
+        (({ 'type': type_ }, n) for type_, n in dropped.items()))
+
+    pool = processpool.render_scheduler
+    _metric(lines, 'lucia_processpool_pending', 'gauge', 'Render jobs submitted but not finished.', (({}, pool.pending),))
+    _metric(lines, 'lucia_processpool_rejected_total', 'counter', 'Render jobs rejected because the queue was full.', (({}, pool.rejected),))
+    _metric(lines, 'lucia_processpool_timeouts_total', 'counter', 'Render jobs that timed out.', (({}, pool.timeouts),))
+
+    db_pools = db_context.get_pool_stats()
+    _metric(lines, 'lucia_db_pool_connections', 'gauge', 'Database connections by state.',
+        (({ 'pool': name, 'state': state }, stats[state]) for name, stats in db_pools.items() for state in ('inUse', 'idle', 'size', 'max')))
+    _metric(lines, 'lucia_db_pool_waiting', 'gauge', 'Requests waiting for a database connection.',
+        (({ 'pool': name }, stats['waiting']) for name, stats in db_pools.items()))
+    _metric(lines, 'lucia_db_pool_acquire_timeouts_total', 'counter', 'Requests that timed out waiting for a database connection.',
+        (({ 'pool': name }, stats['timeouts']) for name, stats in db_pools.items()))
+
+    caches = get_cache_stats()
+    _metric(lines, 'lucia_cache_entries', 'gauge', 'Entries in each in-process cache.',
+        (({ 'cache': name }, stats['size']) for name, stats in caches.items()))
+    _metric(lines, 'lucia_cache_hits_total', 'counter', 'Lookups answered by each in-process cache.',
+        (({ 'cache': name }, stats['hits']) for name, stats in caches.items()))
+    _metric(lines, 'lucia_cache_stale_hits_total', 'counter', 'Lookups answered with a stale value while it is refreshed.',
+        (({ 'cache': name }, stats['staleHits']) for name, stats in caches.items() if 'staleHits' in stats))
+    _metric(lines, 'lucia_cache_misses_total', 'counter', 'Lookups each in-process cache could not answer.',
+        (({ 'cache': name }, stats['misses']) for name, stats in caches.items()))
+
+    _metric(lines, 'lucia_event_loop_lag_seconds', 'gauge', 'Event loop lag, last measured.', (({}, _loop_lag),))
+    _metric(lines, 'lucia_event_loop_lag_max_seconds', 'gauge', 'Largest event loop lag since the last scrape.', (({}, _loop_lag_max),))
+    _loop_lag_max = 0.0
+
+    return '\n'.join(lines) + '\n'
+
+
+async def init():
+    'Kickstarts measuring the event loop lag.'
+    loop = asyncio.get_event_loop()
+    def _service(expected: float):
+        global _loop_lag, _loop_lag_max
+        now = loop.time()
+        _loop_lag = max(now - expected, 0.0)
+        _loop_lag_max = max(_loop_lag_max, _loop_lag)
+        loop.call_at(now + 0.5, _service, now + 0.5)
+
+    _service(loop.time())
+
+    logger.info('Metrics loaded successfully!')
@@ -0,0 +1,45 @@
+import asyncio
+
+from service_config import JIEBA_CACHE_DIR, JIEBA_SENTENCE_CACHE_SIZE, LAZY_IMPORTS
+from .cache import LRUCache
+from .imports import lazy_import
+from .log import logger
+
+
+# 不能延迟导入 jieba.posseg：查找子模块时就会执行 jieba 包本身
+jieba = lazy_import('jieba')
+
+
+def _initialize():
+    # 词典缓存（序列化好的词典）放在这里，构建镜像时会预先生成，启动时直接读取
+    jieba.dt.tmp_dir = JIEBA_CACHE_DIR
+    jieba.dt.initialize()
+
+
+async def init():
+    'Loads the jieba dictionary before any message needs it.'
+    load = asyncio.get_event_loop().run_in_executor(None, _initialize)
+    # 延迟导入时不等待加载完成，先让机器人上线
+    if LAZY_IMPORTS:
+        return
+    await load
+
+    logger.info('Jieba dictionary loaded successfully!')
+
+
+# 分词结果的缓存。在事件循环里查找，命中时不必经过线程池
+_sentence_cache: LRUCache[str, tuple[tuple[str, str], ...]] = LRUCache(JIEBA_SENTENCE_CACHE_SIZE, name='jieba_sentence')
+
+
+def _pos_cut(sentence: str) -> tuple[tuple[str, str], ...]:
+    from jieba import posseg
+    _initialize() # 已经加载过时什么也不做
+    return tuple((word.word, word.flag) for word in posseg.cut(sentence))
+
+
+async def pos_cut(sentence: str) -> tuple[tuple[str, str], ...]:
+    'Segments the sentence into (word, flag) pairs in a thread, so the event loop is not blocked.'
+    if (words := _sentence_cache.get(sentence)) is None:
+        words = await asyncio.get_event_loop().run_in_executor(None, _pos_cut, sentence)
+        _sentence_cache.put(sentence, words)
+    return words
@@ -1,3 +1,156 @@
+import asyncio
+import time
+from collections import deque
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Hashable
 
-processpool_executor = ProcessPoolExecutor(max_workers=3)
+from service_config import PROCESSPOOL_SIZE, PROCESSPOOL_MAX_QUEUE, PROCESSPOOL_JOB_TIMEOUT, PROCESSPOOL_RECYCLE_AFTER
+from .broadcast import broadcast_every_second
+from .common import ServiceException
+from .log import logger
+
+
+# 每个工作进程启动时要运行一次的函数，例如预先加载图片、字体等资源
+_worker_initializers: list[Callable[[], None]] = []
+
+
+def on_worker_start(func: Callable[[], None]) -> Callable[[], None]:
+    'Decorator to register a function to run once in each worker process when it starts.'
+    _worker_initializers.append(func)
+    return func
+
+
+def _initialize_worker(initializers: list[Callable[[], None]]):
+    for func in initializers:
+        # 预加载失败不应该弄坏整个进程池，之后用到时会再加载一次
+        try:
+            func()
+        except Exception as e:
+            logger.exception(e)
+
+
+class RenderScheduler:
+    '''Runs jobs in the process pool with admission control: a bounded number of jobs,
+    one job at a time per key, a timeout per job, and workers replaced after a number of jobs.
+    '''
+
+    def __init__(self, workers: int, max_queue: int, timeout: float, recycle_after: int) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.recycle_after = recycle_after
+        # 已提交但尚未完成的任务数（包括正在运行的）
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        # 最近完成的任务耗时（秒）
+        self._latencies: deque[float] = deque(maxlen=200)
+        # 正在进行的任务，以及它所在的进程池
+        self._inflight: dict[Hashable, tuple[asyncio.Future, ProcessPoolExecutor]] = {}
+        self._executor = self._new_executor()
+        self._executor_jobs = 0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_initialize_worker,
+            initargs=(_worker_initializers,),
+        )
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor_jobs >= self.recycle_after:
+            # 换一批新的工作进程。旧的进程池会在做完手头的任务后退出
+            self._executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+            self._executor_jobs = 0
+        self._executor_jobs += 1
+        return self._executor
+
+    async def run(self, key: Hashable, func: Callable[..., Any], *args) -> Any:
+        '''Runs `func(*args)` in a worker process. If a job of the same key is still running,
+        waits for that job instead. Raises `ServiceException` when busy or timed out.
+        '''
+        if (job := self._inflight.get(key)) is None:
+            if self.pending >= self.max_queue:
+                self.rejected += 1
+                raise ServiceException('现在有点忙，请稍后再试')
+            self.pending += 1
+            executor = self._get_executor()
+            fut = asyncio.ensure_future(self._run(executor, func, args))
+            job = self._inflight[key] = (fut, executor)
+            fut.add_done_callback(lambda f: self._job_done(key, f))
+        fut, executor = job
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._abandon(key, fut, executor)
+            raise ServiceException('处理超时，请稍后再试')
+        except BrokenProcessPool:
+            # 同一个进程池里的其他任务超时，进程池被换掉了
+            raise ServiceException('处理失败，请稍后再试')
+
+    async def _run(self, executor: ProcessPoolExecutor, func: Callable[..., Any], args: tuple) -> Any:
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            self._latencies.append(time.perf_counter() - start)
+
+    def _abandon(self, key: Hashable, fut: asyncio.Future, executor: ProcessPoolExecutor):
+        # 超时的任务多半卡住了，它会一直占着名额和工作进程，而且同一个键之后的请求都会等它。
+        # 所以不再等它，并结束它所在的进程池（其中的其他任务会失败），换一批新的工作进程
+        # 同一个任务的其他等待者也会超时，只处理一次
+        if self._inflight.get(key, (None,))[0] is not fut or fut.done():
+            return
+        del self._inflight[key]
+        if executor is self._executor:
+            self._executor = self._new_executor()
+            self._executor_jobs = 0
+        logger.warning('Render job timed out; replacing the process pool.')
+        processes = list((executor._processes or {}).values())
+        executor.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
+
+    def _job_done(self, key: Hashable, fut: asyncio.Future):
+        if self._inflight.get(key, (None,))[0] is fut:
+            del self._inflight[key]
+        # 超时后没有人等待结果，在这里取走异常以免报错
+        if not fut.cancelled():
+            fut.exception()
+
+    def get_stats(self) -> dict[str, Any]:
+        latencies = sorted(self._latencies)
+        return {
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'latencyP50': latencies[len(latencies) // 2] if latencies else None,
+            'latencyMax': latencies[-1] if latencies else None,
+        }
+
+
+render_scheduler = RenderScheduler(
+    PROCESSPOOL_SIZE,
+    max_queue=PROCESSPOOL_MAX_QUEUE,
+    timeout=PROCESSPOOL_JOB_TIMEOUT,
+    recycle_after=PROCESSPOOL_RECYCLE_AFTER,
+)
+
+
+async def get_stats() -> dict[str, Any]:
+    'Gets the queue length and recent job latency of the render process pool.'
+    return render_scheduler.get_stats()
+
+
+async def init():
+    'Kickstarts broadcasting of the process pool status.'
+    broadcast_every_second('renderPool', get_stats)
+
+    logger.info('Process pool loaded successfully!')
@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    'Allows `rate` actions per second on average, and bursts of up to `burst` actions.'
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        'Takes a token if one is available right now.'
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        'Waits until a token is available and takes it.'
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self._tokens) / self.rate)
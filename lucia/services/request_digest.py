@@ -0,0 +1,117 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Optional
+
+from nonebot import NoneBot, get_bot
+from nonebot.exceptions import CQHttpError
+from nonebot.helpers import send_to_superusers
+
+from service_config import REQUEST_DIGEST_WINDOW, REQUEST_DIGEST_MAX_ITEMS, REQUEST_HISTORY_SIZE
+from .broadcast import broadcast, has_subscribers, is_clustered, share_counts, on_shared_counts
+from .log import logger
+
+
+# 最近收到的请求，供新连接的监控面板读取
+_history: deque[dict[str, Any]] = deque(maxlen=REQUEST_HISTORY_SIZE)
+
+# 等待合并发送给超级用户的请求描述
+_digest: list[str] = []
+_digest_bot: Optional[NoneBot] = None
+_digest_timer: Optional[asyncio.TimerHandle] = None
+
+# 多个工作进程时，一段时间内的请求都交给最先收到请求的工作进程合并发送，以免超级用户收到多条摘要。
+# 值为 (负责的进程 pid, 截止时刻)
+_owner: Optional[tuple[int, float]] = None
+
+
+def _describe(request: dict[str, Any]) -> str:
+    if request['kind'] == 'friend':
+        msg = f'用户 {request["userId"]} 请求添加好友。消息：{request["comment"]}'
+    else:
+        msg = f'用户 {request["userId"]} 邀请加入群 {request["groupId"]}。消息：{request["comment"]}'
+    if request['approved']:
+        msg += '（已自动接受）'
+    return msg
+
+
+def add_request(bot: NoneBot, kind: str, user_id: int, group_id: Optional[int], comment: str, approved: bool):
+    '''Records a friend request (`kind` is 'friend') or group invitation ('group'). It is broadcast
+    to the dashboard right away, and sent to superusers in a digest with the other requests that
+    arrive within REQUEST_DIGEST_WINDOW seconds, in whichever worker process they arrive.
+    '''
+    request = {
+        'time': int(time.time()),
+        'kind': kind,
+        'userId': user_id,
+        'groupId': group_id,
+        'comment': comment,
+        'approved': approved,
+    }
+    _history.append(request)
+    # 监控面板首先收到最近的所有请求，之后广播的都是新增的请求。监控面板可能连在另一个工作进程上
+    if has_subscribers('requests'):
+        asyncio.create_task(broadcast('requests', lambda: _as_list(request), shared=True))
+
+    owner, until = _current_owner()
+    if owner == os.getpid():
+        _collect(bot, request)
+    if is_clustered():
+        share_counts('requests', { 'request': request, 'owner': owner, 'until': until })
+
+
+def _current_owner() -> tuple[int, float]:
+    global _owner
+    if _owner is None or _owner[1] <= time.time():
+        _owner = (os.getpid(), time.time() + REQUEST_DIGEST_WINDOW)
+    return _owner
+
+
+@on_shared_counts('requests')
+def _merge(data: dict[str, Any]):
+    global _owner
+    # 其他工作进程收到的请求，已经广播给监控面板了，这里只需记录下来
+    _history.append(data['request'])
+    if data['owner'] == os.getpid():
+        _collect(_digest_bot or get_bot(), data['request'])
+    elif _owner is None or _owner[1] <= time.time():
+        _owner = (data['owner'], data['until'])
+
+
+def _collect(bot: NoneBot, request: dict[str, Any]):
+    global _digest_bot, _digest_timer
+    _digest.append(_describe(request))
+    _digest_bot = bot
+    if len(_digest) >= REQUEST_DIGEST_MAX_ITEMS:
+        asyncio.create_task(send_digest())
+    elif _digest_timer is None:
+        _digest_timer = asyncio.get_event_loop().call_later(
+            REQUEST_DIGEST_WINDOW, lambda: asyncio.create_task(send_digest()),
+        )
+
+
+async def _as_list(request: dict[str, Any]) -> list[dict[str, Any]]:
+    return [request]
+
+
+async def get_history() -> list[dict[str, Any]]:
+    'Gets the most recent requests, oldest first.'
+    return list(_history)
+
+
+async def send_digest():
+    'Sends the requests collected so far to superusers as one message each.'
+    global _digest_timer
+    if _digest_timer is not None:
+        _digest_timer.cancel()
+        _digest_timer = None
+    if not _digest or _digest_bot is None:
+        return
+    lines = _digest.copy()
+    _digest.clear()
+    msg = lines[0] if len(lines) == 1 else f'收到 {len(lines)} 个请求：\n' + '\n'.join(lines)
+    try:
+        await send_to_superusers(_digest_bot, msg)
+    except CQHttpError as e:
+        logger.exception(e)
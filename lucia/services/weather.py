@@ -1,15 +1,49 @@
-from aiocache import cached
+import os
 
-from .common import fetch_text
+from .cache import StaleWhileRevalidateCache
+from .common import ServiceException, fetch_text
+from .log import logger
+from service_config import WEATHER_API_ROOT, WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL, WEATHER_CACHE_STALE_TTL, \
+    WEATHER_CACHE_NEGATIVE_TTL, WEATHER_CACHE_SNAPSHOT
+
+
+# 过期不久的结果仍然先返回，同时在后台刷新；查询失败也短暂缓存
+_cache = StaleWhileRevalidateCache(
+    WEATHER_CACHE_SIZE,
+    ttl=WEATHER_CACHE_TTL,
+    stale_ttl=WEATHER_CACHE_STALE_TTL,
+    negative_ttl=WEATHER_CACHE_NEGATIVE_TTL,
+    negative_exceptions=(ServiceException,),
+    name='weather',
+)
+
+
+def _normalize_city(city: str) -> str:
+    # 只合并空白与大小写：“ 香港” 与 “香港”、“Hong  Kong” 与 “hong kong” 使用同一个缓存
+    return ' '.join(city.split()).lower()
 
 
-@cached(ttl=60) # 结果缓存 60 秒
 async def get_current_weather_short(city: str) -> str:
-    return (await fetch_text(f'https://wttr.in/{city}?format=1')).strip()
+    city = _normalize_city(city)
+    return await _cache.get(
+        f'short:{city}',
+        lambda: _fetch_current_weather_short(city),
+    )
+
+
+async def _fetch_current_weather_short(city: str) -> str:
+    return (await fetch_text(f'{WEATHER_API_ROOT}/{city}?format=1')).strip()
 
 
-@cached(ttl=60)
 async def get_current_weather_desc(city: str) -> str:
+    city = _normalize_city(city)
+    return await _cache.get(
+        f'desc:{city}',
+        lambda: _fetch_current_weather_desc(city),
+    )
+
+
+async def _fetch_current_weather_desc(city: str) -> str:
     _format = (
         '%l:\n'
         '+%c+%C:+%t\n'
@@ -17,4 +51,24 @@ async def get_current_weather_desc(city: str) -> str:
         '+💧+Precipitation:+%p\n'
         '+🍃+Wind:+%w'
     )
-    return await fetch_text(f'https://wttr.in/{city}?format={_format}')
+    return await fetch_text(f'{WEATHER_API_ROOT}/{city}?format={_format}')
+
+
+async def init():
+    'Loads the weather cache snapshot saved by the last run, if any.'
+    if WEATHER_CACHE_SNAPSHOT and os.path.exists(WEATHER_CACHE_SNAPSHOT):
+        try:
+            _cache.load(WEATHER_CACHE_SNAPSHOT)
+        except (OSError, ValueError) as e:
+            logger.exception(e)
+
+    logger.info('Weather cache loaded successfully!')
+
+
+async def shutdown():
+    'Saves the weather cache snapshot.'
+    if WEATHER_CACHE_SNAPSHOT:
+        try:
+            _cache.save(WEATHER_CACHE_SNAPSHOT)
+        except OSError as e:
+            logger.exception(e)